@@ -17,62 +17,1256 @@ repetition.
 
 """
 
+import argparse
+import atexit
+import codecs
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
 import io
 import json
 import logging
+import logging.handlers
+import os
 import posixpath
+import queue
+import re
+import sqlite3
+import stat
+import sys
 import tarfile
+import threading
+import time
+import traceback
 
 import docker
+import docker.errors
+import docker.utils
 import yaml
 
+try:
+    import grp
+    import pwd
+except ImportError:
+    # There are no user and group databases, e.g. on Windows.
+    grp = pwd = None
 
 END = '\033[0m'
 BOLD = '\033[1m{}' + END
 
+HISTORY_FILE = '.moby.sqlite'
+HISTORY_REGRESSION = 0.2
+HISTORY_RUNS = 5
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS envs (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    duration REAL NOT NULL,
+    pushed INTEGER NOT NULL,
+    pulled INTEGER NOT NULL,
+    exit_code INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    env TEXT NOT NULL,
+    command TEXT NOT NULL,
+    duration REAL NOT NULL,
+    exit_code INTEGER NOT NULL
+);
+"""
+LOG_INTERVAL = 0.05
+JOURNAL_FILE = '.moby-journal.json'
+PIPELINE_WORKERS = 4
+PULL_WORKERS = 4
+RESOURCE_IDLE_WARNING = 5.0
+RESOURCE_MEMORY_WARNING = 0.9
+RESOURCE_TIMEOUT = 5
+RESUME_LABEL = 'moby.resume'
+RESUME_REPOSITORY = 'moby-resume'
+SCAN_BATCH = 64
+SCAN_READ_LIMIT = 1024 * 1024
+SCAN_WINDOW = 16
+SCAN_WORKERS = 8
+
+UNSAFE_FILENAME = re.compile(r'[^\w-]+')
+WHITESPACE = re.compile(r'\s*')
+
+
+class EnvRecord(object):
+    """
+    Record the run of an environment.
+
+    The record keeps track of the duration of the environment and its
+    commands, the number of bytes pushed and pulled and the exit code. It is
+    saved to the history by `save_history`.
+
+    With a journal, the steps of the environment are journaled and steps that
+    completed in the run that is resumed are skipped. A record with skipped
+    steps is `resumed` and isn't saved to the history, as its duration and
+    exit code don't cover the whole environment.
+
+    """
+
+    def __init__(self, name, journal=None):
+        """
+        Initialise the record and start timing the environment.
+
+        Args:
+            name (str): The name of the environment.
+
+        Keyword Args:
+            journal (.Journal): The journal of the run.
+
+        """
+        self.name = name
+        self.journal = journal
+        self.resumed = False
+        self.step = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.pushed = 0
+        self.pulled = 0
+        self.exit_code = 0
+        self.commands = []
+        self.resources = None
+
+    @property
+    def duration(self):
+        """float: The number of seconds the environment ran."""
+        return (self.finished or time.monotonic()) - self.started
+
+    def add_command(self, command, started, exit_code):
+        """
+        Record a command that finished.
+
+        Args:
+            command (str): The command.
+            started (float): The `time.monotonic` the command started at.
+            exit_code (int): The exit code of the command.
+
+        """
+        self.commands.append({
+            'command': command,
+            'started': started,
+            'finished': time.monotonic(),
+            'exit_code': exit_code,
+        })
+        if exit_code:
+            self.exit_code = exit_code
+
+    def complete(self):
+        """Journal the step started by `skip` as completed."""
+        if self.journal is not None:
+            self.journal.complete(self.step)
+
+    def fail(self):
+        """
+        Record that the environment failed.
+
+        The exit code of a failed command is kept. When the environment failed
+        otherwise, e.g. because a pull failed or it was interrupted, the exit
+        code is set to 1.
+
+        """
+        if not self.exit_code:
+            self.exit_code = 1
+
+    def finish(self):
+        """Stop timing the environment, if not stopped already."""
+        if self.finished is None:
+            self.finished = time.monotonic()
+
+    def skip(self, *parts):
+        """
+        Start a step and check whether it can be skipped.
+
+        Args:
+            *parts: The parts that identify the step, see `fingerprint`.
+
+        Returns:
+            bool: Whether the step completed in the run that is resumed.
+
+        """
+        if self.journal is None:
+            return False
+        self.step = fingerprint(self.name, *parts)
+        skip = self.journal.skip(self.step)
+        if skip:
+            self.resumed = True
+        return skip
+
+
+class Host(object):
+    """
+    A docker host to run environments on.
+
+    The host runs up to `capacity` environments at once. `running` is the
+    number of environments it is running.
+
+    """
+
+    def __init__(self, client, capacity, url=None):
+        """
+        Initialise the host.
+
+        Args:
+            client (.docker.APIClient): The docker client of the host.
+            capacity (int): The number of environments the host can run at
+                once.
+
+        Keyword Args:
+            url (str): The URL of the daemon as configured. Unlike the base
+                URL of the client, it tells local daemons apart.
+
+        """
+        self.client = client
+        self.capacity = capacity
+        self.url = url
+        self.running = 0
+        self.image = None
+
+    @property
+    def free(self):
+        """int: The number of environments the host can start."""
+        return self.capacity - self.running
+
+
+class Journal(object):
+    """
+    Journal the completed steps of a run, so a failed run can be resumed.
+
+    Steps are identified by their fingerprint and journaled in the order they
+    complete. When resuming, the steps completed by the previous run are
+    skipped, in order, and the steps after them are run. The image to resume
+    from holds the effects of every completed step, so a completed step that
+    changed can't be run again on it; see `ResumeError`.
+
+    """
+
+    def __init__(self, path, build=None, image=None, completed=None):
+        """
+        Initialise the journal.
+
+        Args:
+            path (str): The path of the journal file.
+
+        Keyword Args:
+            build (str): The fingerprint of the build, see `build_fingerprint`.
+            image (str): The id of the image to resume from.
+            completed (list): The steps (`str`) completed by the run that is
+                resumed.
+
+        """
+        self.path = path
+        self.build = build
+        self.image = image
+        self.completed = completed or []
+        self.steps = []
+        self.resuming = bool(self.completed)
+
+    def complete(self, step):
+        """
+        Journal a completed step.
+
+        Args:
+            step (str): The fingerprint of the step.
+
+        """
+        self.steps.append(step)
+        self.save()
+
+    def remove(self):
+        """Remove the journal file, there is nothing left to resume."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        """Write the journal file."""
+        with open(self.path, 'w') as journal:
+            json.dump({
+                'build': self.build,
+                'image': self.image,
+                'steps': self.steps,
+            }, journal)
+
+    def skip(self, step):
+        """
+        Check whether a step can be skipped.
+
+        Args:
+            step (str): The fingerprint of the step.
+
+        Returns:
+            bool: Whether the step is the next step completed by the run that
+                is resumed.
+
+        Raises:
+            ResumeError: When the step differs from the step the run that is
+                resumed completed at this point.
+
+        """
+        index = len(self.steps)
+        if self.resuming and index < len(self.completed):
+            if self.completed[index] != step:
+                raise ResumeError(
+                    'A step that completed in the failed run changed, so it '
+                    "can't be resumed. Run moby without --resume.")
+            self.steps.append(step)
+            return True
+        self.resuming = False
+        return False
+
+
+class LogWriter(threading.Thread):
+    """
+    Write queued log records in the background.
+
+    Records are taken from the queue in batches. The messages of a batch are
+    coalesced into a single write to the console, which is written at most
+    once per interval.
+
+    All records are written to `moby.log`. Records of a stream (see
+    `StreamLogger`) are also written to a log file per stream and, if the
+    record was logged by a command, to a log file per command. See
+    `log_name`. On the console, records of streams that are logged concurrently
+    are prefixed with the name of their stream.
+
+    """
+
+    def __init__(self, records, console, level=logging.INFO,
+                 interval=LOG_INTERVAL, log_dir=None):
+        """
+        Initialise the log writer.
+
+        Args:
+            records (.queue.Queue): The queue to take the records from.
+            console (file): The stream to write the console output to.
+
+        Keyword Args:
+            level (int): The level of records to write to the console.
+            interval (float): The minimum number of seconds between writes to
+                the console.
+            log_dir (str): The directory to write the log files to. When
+                omitted no log files are written.
+
+        """
+        super().__init__(daemon=True)
+        self.records = records
+        self.console = console
+        self.level = level
+        self.interval = interval
+        self.log_dir = log_dir
+        self.files = {}
+        self.line_start = {}
+        self.last_stream = None
+
+    def handle_error(self, note=None):
+        """
+        Report an error writing records.
+
+        Like `.logging.Handler.handleError`, the traceback is written to
+        stderr, so the writer keeps running.
+
+        Args:
+            note (str): A note to write after the traceback.
+
+        """
+        try:
+            sys.stderr.write('--- Logging error ---\n')
+            traceback.print_exc(file=sys.stderr)
+            if note:
+                sys.stderr.write(note)
+        except OSError:
+            # There is nowhere left to report to.
+            pass
+
+    def log_file(self, name):
+        """
+        Get a log file.
+
+        Args:
+            name (str): The name of the log file, without extension. See
+                `log_name`.
+
+        Returns:
+            file: The log file, opened for appending.
+
+        """
+        if name not in self.files:
+            os.makedirs(self.log_dir, exist_ok=True)
+            path = os.path.join(self.log_dir, name + '.log')
+            self.files[name] = open(path, 'a')
+        return self.files[name]
+
+    def prefix(self, stream, message):
+        """
+        Prefix the lines of a message with the name of its stream.
+
+        The console may be halfway a line of another stream, in that case a
+        newline is inserted first.
+
+        Args:
+            stream (str): The name of the stream.
+            message (str): The message to prefix.
+
+        Returns:
+            str: The prefixed message.
+
+        """
+        lines = []
+        if self.last_stream != stream and not self.line_start.get(
+                self.last_stream, True):
+            lines.append('\n')
+            self.line_start[self.last_stream] = True
+        self.last_stream = stream
+        for line in message.splitlines(keepends=True):
+            if self.line_start.get(stream, True):
+                lines.append('[{}] '.format(stream))
+            lines.append(line)
+            self.line_start[stream] = line.endswith('\n')
+        return ''.join(lines)
+
+    def run(self):
+        """Write the queued records until the writer is stopped."""
+        stopped = False
+        while not stopped:
+            records = [self.records.get()]
+            time.sleep(self.interval)
+            while True:
+                try:
+                    records.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                stopped = True
+                records = records[:records.index(None)]
+            try:
+                self.write(records)
+            except Exception:
+                self.handle_error()
+        for log_file in self.files.values():
+            log_file.close()
+
+    def stop(self):
+        """Stop the writer after it wrote the queued records."""
+        self.records.put(None)
+        self.join()
+
+    def write(self, records):
+        """
+        Write a batch of records.
+
+        Args:
+            records (list): The records (`.logging.LogRecord`) to write.
+
+        """
+        console = []
+        for record in records:
+            if record.levelno >= self.level:
+                message = record.getMessage()
+                if getattr(record, 'prefix', False):
+                    message = self.prefix(
+                        getattr(record, 'stream', None), message)
+                console.append(message)
+        if console:
+            self.console.write(''.join(console))
+            self.console.flush()
+        if self.log_dir:
+            try:
+                self.write_files(records)
+            except Exception:
+                self.log_dir = None
+                self.handle_error('Writing log files is disabled.\n')
+
+    def write_files(self, records):
+        """
+        Write a batch of records to the log files.
+
+        Args:
+            records (list): The records (`.logging.LogRecord`) to write.
+
+        """
+        written = set()
+        for record in records:
+            stream = getattr(record, 'stream', None)
+            names = ['moby']
+            if stream:
+                names.append(
+                    log_name(getattr(record, 'kind', 'env'), stream))
+                if getattr(record, 'command', None):
+                    names.append('{}.{}'.format(
+                        names[-1], log_name('cmd', record.command)))
+            for name in names:
+                log_file = self.log_file(name)
+                log_file.write(record.getMessage())
+                written.add(log_file)
+        for log_file in written:
+            log_file.flush()
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Sample the resource usage of a container in the background.
+
+    The samples are taken from the docker stats API, which streams a sample
+    about every second until the container stops. See `parse_stats` for the
+    contents of a sample.
+
+    """
+
+    def __init__(self, client, container):
+        """
+        Initialise the sampler.
+
+        Args:
+            client (.docker.APIClient): The docker client to use.
+            container (str): The id of the container.
+
+        """
+        super().__init__(daemon=True)
+        self.client = client
+        self.container = container
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Sample the container until it or the sampler is stopped."""
+        try:
+            stats = self.client.stats(self.container, decode=True, stream=True)
+            for sample in stats:
+                if self.stopped.is_set():
+                    break
+                sample = parse_stats(sample)
+                sample['time'] = time.monotonic()
+                self.samples.append(sample)
+        except docker.errors.DockerException:
+            # The container is gone, so there is nothing left to sample.
+            pass
+
+    def stop(self):
+        """Stop sampling."""
+        self.stopped.set()
+        self.join(RESOURCE_TIMEOUT)
+
+
+class ResumeError(SystemExit):
+    """
+    A failed run can't be resumed.
+
+    The run stops without committing its container, so the journal and the
+    image of the failed run are kept.
+
+    """
+
+
+class StreamLogger(logging.LoggerAdapter):
+    """
+    Log the output of a stream, e.g. an environment.
+
+    The records are tagged with the name and kind of the stream, so the
+    `LogWriter` can write them to a log file of the stream.
+
+    """
+
+    def __init__(self, logger, stream, prefix=False, kind='env'):
+        """
+        Initialise the stream logger.
+
+        Args:
+            logger (.logging.Logger): The logger to log to.
+            stream (str): The name of the stream.
+
+        Keyword Args:
+            prefix (bool): Whether to prefix the console output with the name
+                of the stream. Used when streams are logged concurrently.
+            kind (str): The kind of the stream, `env` for an environment and
+                `host` for building the image on a host. See `log_name`.
+
+        """
+        super().__init__(
+            logger, {'stream': stream, 'prefix': prefix, 'kind': kind})
+
+    def process(self, msg, kwargs):
+        """Merge the extra of the stream with the extra of the call."""
+        kwargs['extra'] = dict(self.extra, **kwargs.get('extra', {}))
+        return msg, kwargs
+
+
+def add_files(archive, files):
+    """
+    Add files to an archive.
+
+    Regular files that were added before under another path are added as a
+    hard link, like `.tarfile.TarFile.gettarinfo` does.
+
+    Args:
+        archive (.tarfile.TarFile): The archive to add the files to.
+        files (list): Tuples of the path (`str`), status (`.os.stat_result`),
+            header (`.tarfile.TarInfo`) and contents (`bytes`) of every file
+            as read by `read_files`. The contents are `None` for files that
+            weren't read ahead.
+
+    """
+    for path, status, tarinfo, data in files:
+        if tarinfo is None:
+            continue
+        if tarinfo.isreg() and status.st_ino:
+            inode = (status.st_ino, status.st_dev)
+            if status.st_nlink > 1 and inode in archive.inodes and \
+                    tarinfo.name != archive.inodes[inode]:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = archive.inodes[inode]
+                tarinfo.size = 0
+            else:
+                archive.inodes[inode] = tarinfo.name
+        if not tarinfo.isreg():
+            archive.addfile(tarinfo)
+        elif data is not None:
+            archive.addfile(tarinfo, io.BytesIO(data))
+        else:
+            with open(path, 'rb') as fileobj:
+                archive.addfile(tarinfo, fileobj)
+
+
+def any_failed(futures):
+    """
+    Check whether any of the futures failed.
+
+    Args:
+        futures (list): The futures (`.concurrent.futures.Future`).
+
+    Returns:
+        bool: Whether a future is done and raised an exception.
+
+    """
+    return any(
+        future.done() and future.exception() is not None
+        for future in futures)
+
+
+def archive_fingerprint(archive):
+    """
+    Fingerprint a tar archive.
+
+    The headers and contents of the members are fingerprinted, except for the
+    modification times of directories. Those change when files are written
+    to a directory, also when the files are excluded from the archive.
 
-def build_image(client, logger):
+    Args:
+        archive (bytes): The tar archive.
+
+    Returns:
+        str: The fingerprint.
+
+    """
+    parts = []
+    archive = tarfile.open(fileobj=io.BytesIO(archive), mode='r')
+    for member in archive:
+        header = member.get_info()
+        del header['chksum']
+        if member.isdir():
+            del header['mtime']
+        header['type'] = header['type'].decode()
+        parts.append(header)
+        if member.isreg():
+            parts.append(archive.extractfile(member).read())
+    return fingerprint(*parts)
+
+
+def begin_env(client, container, env, logger, archive=None, record=None):
+    """
+    Begin running an environment.
+
+    Run the `before`, `push` and `run` entries of the environment.
+
+    Args:
+        container (str): The id of the container.
+        env (dict): The environment to run.
+
+    Keyword Args:
+        archive (bytes): A prepared archive of the `push` entry.
+        record (.EnvRecord): The record of the environment.
+
+    """
+    if 'before' in env:
+        run_env(client, container, env['before'], logger, record=record)
+
+    if 'push' in env:
+        push(
+            client, container, env['push'], logger, archive=archive,
+            exclude=env.get('exclude'), ignore_files=env.get('ignore_files'),
+            record=record)
+
+    for command in env.get('run', []):
+        run_command(client, container, command, logger, record=record)
+
+
+def build_fingerprint():
+    """
+    Fingerprint the build.
+
+    Only the `Dockerfile` and the `.dockerignore` file are fingerprinted,
+    changes to the files the `Dockerfile` copies are not detected.
+
+    Returns:
+        str: The fingerprint.
+
+    """
+    parts = []
+    for path in ['Dockerfile', '.dockerignore']:
+        if os.path.isfile(path):
+            with open(path, 'rb') as build_file:
+                parts.append(build_file.read())
+        else:
+            parts.append(None)
+    return fingerprint(*parts)
+
+
+def build_image(client, logger, cache=None):
     """
     Build the docker image.
 
     Build the docker image from the Dockerfile in the current directory.
+    The build output is logged per chunk received from the daemon.
+
+    Keyword Args:
+        cache (dict): The `cache` entry of the config. Its images are pulled
+            and used as layer cache, and pushed after the build if requested.
 
     Returns:
         str: The id of the built image.
 
+    Raises:
+        SystemExit: When the build fails a SystemExit is raised with the
+            error message of the daemon.
+
     """
+    kwargs = {}
+    if cache:
+        kwargs['cache_from'] = pull_cache(client, cache, logger)
     logger.info(BOLD.format('Building image...\n'))
-    image = client.build(
-        path='.')
-    for line in image:
-        line = json.loads(line.decode())
-        logger.debug(line['stream'])
-    image = line['stream'].strip().split()[-1]
+    output = client.build(
+        path='.',
+        **kwargs)
+    image = None
+    stream = ''
+    for messages in decode_stream(output):
+        lines = []
+        for message in messages:
+            error = error_message(message)
+            if error:
+                raise SystemExit(error)
+            if 'aux' in message:
+                image = message['aux'].get('ID', image)
+            if 'stream' in message:
+                if message['stream'].strip():
+                    stream = message['stream']
+                lines.append(message['stream'])
+            elif 'status' in message:
+                lines.append(message['status'] + '\n')
+        if lines:
+            logger.debug(''.join(lines))
+    if image is None:
+        # Daemons that don't send an aux message end with the image id.
+        if not stream.strip():
+            raise SystemExit('The build produced no image.')
+        image = stream.strip().split()[-1]
+    if cache and cache.get('push'):
+        push_cache(client, image, cache, logger)
     return image
 
 
-def init_client():
+def build_images(hosts, logger, cache=None):
+    """
+    Build the docker image on every host.
+
+    The images are built concurrently. The id of the image is stored in the
+    host. Only the first host pushes the cache.
+
+    Args:
+        hosts (list): The hosts (`.Host`).
+
+    Keyword Args:
+        cache (dict): The `cache` entry of the config.
+
+    """
+    with concurrent.futures.ThreadPoolExecutor(len(hosts)) as executor:
+        builds = [
+            executor.submit(
+                build_image, host.client,
+                StreamLogger(logger, host.url, prefix=True, kind='host'),
+                cache=cache if index == 0 or not cache else dict(
+                    cache, push=False))
+            for index, host in enumerate(hosts)
+        ]
+        for host, build in zip(hosts, builds):
+            host.image = build.result()
+
+
+def cache_images(cache):
+    """
+    List the images of the cache config.
+
+    Args:
+        cache (dict): The `cache` entry of the config.
+
+    Returns:
+        list: The names (`str`) of the images, prefixed with the registry if
+            one is configured.
+
+    """
+    registry = cache.get('registry')
+    return [
+        '{}/{}'.format(registry, image) if registry else image
+        for image in cache.get('images', [])
+    ]
+
+
+def check_stream(output, logger):
+    """
+    Check the JSON messages streamed by a pull or push.
+
+    Args:
+        output (iterable): The chunks (`bytes`) streamed by the daemon.
+
+    Raises:
+        .docker.errors.DockerException: When the daemon reports an error.
+
+    """
+    for messages in decode_stream(output):
+        for message in messages:
+            error = error_message(message)
+            if error:
+                raise docker.errors.DockerException(error)
+            if 'status' in message:
+                logger.debug(message['status'] + '\n')
+
+
+def commit_container(client, container, journal, logger):
+    """
+    Commit a failed container, so the run can be resumed from it.
+
+    The image is labelled with the current directory, so
+    `remove_resume_images` can find it.
+
+    Args:
+        container (str): The id of the container.
+        journal (.Journal): The journal to save the committed image in.
+
+    """
+    logger.info(BOLD.format('Committing container...\n'))
+    image = client.commit(
+        container, repository=RESUME_REPOSITORY,
+        conf={'Labels': {RESUME_LABEL: os.getcwd()}})
+    journal.image = image['Id']
+    journal.save()
+    logger.info('Run `moby --resume` to resume the run.\n')
+
+
+def compile_pattern(pattern):
+    """
+    Compile an exclude pattern.
+
+    Like `.fnmatch`, except that `*`, `?` and sets don't match a slash. A
+    `**` matches any number of directories.
+
+    Args:
+        pattern (str): The pattern.
+
+    Returns:
+        .re.Pattern: The compiled pattern, which should match the whole path.
+
+    """
+    parts = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith('**/', index):
+            parts.append('(?:.*/)?')
+            index += 3
+        elif pattern.startswith('**', index):
+            parts.append('.*')
+            index += 2
+        elif pattern[index] == '*':
+            parts.append('[^/]*')
+            index += 1
+        elif pattern[index] == '?':
+            parts.append('[^/]')
+            index += 1
+        elif pattern[index] == '[' and ']' in pattern[index + 2:]:
+            end = pattern.index(']', index + 2)
+            chars = re.sub(r'([\\[&~|])', r'\\\1', pattern[index + 1:end])
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            parts.append('(?!/)[{}]'.format(chars))
+            index = end + 1
+        else:
+            parts.append(re.escape(pattern[index]))
+            index += 1
+    return re.compile(''.join(parts))
+
+
+def complete_env(client, container, env, logger, record=None):
+    """
+    Complete an environment that runs in a container of its own.
+
+    Finish the environment and stop the container, even when finishing it
+    fails. A failure is recorded in the record.
+
+    Args:
+        container (str): The id of the container.
+        env (dict): The environment to complete.
+
+    Keyword Args:
+        record (.EnvRecord): The record of the environment, which is finished
+            before the container is stopped.
+
+    """
+    try:
+        finish_env(client, container, env, logger, record=record)
+    except BaseException:
+        if record:
+            record.fail()
+        raise
+    finally:
+        if record:
+            record.finish()
+        stop_container(client, container, logger)
+
+
+def decode_stream(chunks):
+    """
+    Decode a stream of JSON messages.
+
+    The docker daemon streams JSON messages, but doesn't align them with the
+    chunks it sends. A chunk may contain several messages or only part of
+    one, and multi-byte characters may be split across chunks.
+
+    Args:
+        chunks (iterable): The chunks (`bytes`) of the stream.
+
+    Yields:
+        list: The messages (`dict`) completed by a chunk. Chunks that don't
+            complete a message yield nothing.
+
+    Raises:
+        ValueError: When the stream ends with an incomplete message.
+
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        messages = []
+        index = WHITESPACE.match(buffer).end()
+        while index < len(buffer):
+            try:
+                message, index = decoder.raw_decode(buffer, index)
+            except ValueError:
+                break
+            messages.append(message)
+            index = WHITESPACE.match(buffer, index).end()
+        buffer = buffer[index:]
+        if messages:
+            yield messages
+    buffer += text_decoder.decode(b'', final=True)
+    if buffer.strip():
+        raise ValueError('Incomplete message: {!r}'.format(buffer))
+
+
+def error_message(message):
+    """
+    Get the error of a message streamed by the daemon.
+
+    Args:
+        message (dict): The decoded message.
+
+    Returns:
+        str: The error message, `None` if the message isn't an error.
+
+    """
+    if 'errorDetail' in message:
+        return message['errorDetail'].get('message') or message.get('error')
+    return message.get('error')
+
+
+def estimate_durations(history, names):
+    """
+    Estimate the durations of environments.
+
+    The estimate of an environment is the average duration of its last
+    successful runs.
+
+    Args:
+        history (.sqlite3.Connection): The history database.
+        names (list): The names (`str`) of the environments.
+
+    Returns:
+        dict: The estimated duration (`float`) in seconds per environment
+            name. Environments without successful runs are omitted.
+
+    """
+    durations = {}
+    for name in names:
+        rows = history.execute(
+            'SELECT duration FROM envs WHERE name = ? AND exit_code = 0 '
+            'ORDER BY run DESC LIMIT ?',
+            (name, HISTORY_RUNS)).fetchall()
+        if rows:
+            durations[name] = sum(row[0] for row in rows) / len(rows)
+    return durations
+
+
+def estimate_runtime(names, durations, slots=1):
+    """
+    Estimate the runtime of environments.
+
+    The environments are scheduled in order, each on the slot that frees up
+    first, like `run_distributed` starts them on the host with free capacity.
+    Environments without an estimated duration are left out.
+
+    Args:
+        names (list): The names (`str`) of the environments, in the order
+            they are run.
+        durations (dict): The estimated durations, see `estimate_durations`.
+
+    Keyword Args:
+        slots (int): The number of environments that run at once.
+
+    Returns:
+        float: The estimated runtime in seconds.
+
+    """
+    finished = [0.0] * slots
+    for name in names:
+        if name in durations:
+            heapq.heapreplace(finished, finished[0] + durations[name])
+    return max(finished)
+
+
+def exclude_own_files(config):
+    """
+    Exclude the files moby writes from the `push` entries.
+
+    The history, the journal, the log files and the resource usage change
+    during a run. Pushing them would push moby's state and change the `push`
+    steps, so a failed run couldn't be resumed.
+
+    Args:
+        config (dict): The moby config.
+
+    Returns:
+        dict: The config with the files added to the `exclude` entry of every
+            environment and its `before` and `after` entries.
+
+    """
+    paths = [
+        config.get('history', HISTORY_FILE),
+        JOURNAL_FILE,
+        config.get('log_dir'),
+    ]
+    if isinstance(config.get('resources'), dict):
+        paths.append(config['resources'].get('output'))
+    patterns = []
+    for path in paths:
+        if not path:
+            continue
+        path = os.path.relpath(path)
+        if not os.path.isabs(path) and not path.startswith(os.pardir):
+            patterns.append('/' + re.sub(
+                r'([*?[])', r'[\1]', path.replace(os.sep, '/')))
+
+    def exclude(env):
+        env = dict(env, exclude=list(env.get('exclude', [])) + patterns)
+        for entry in ['before', 'after']:
+            if entry in env:
+                env[entry] = exclude(env[entry])
+        return env
+
+    return dict(config, **{
+        name: exclude(config[name]) for name in config['envlist']
+    })
+
+
+def excluded(path, is_dir, patterns):
+    """
+    Check whether a path is excluded.
+
+    The last pattern that matches the path decides, so negated patterns can
+    include paths again.
+
+    Args:
+        path (str): The path relative to the current directory.
+        is_dir (bool): Whether the path is a directory.
+        patterns (list): The patterns as loaded by `load_excludes`.
+
+    Returns:
+        bool: Whether the path is excluded.
+
+    """
+    path = os.path.normpath(path).replace(os.sep, '/')
+    name = posixpath.basename(path)
+    result = False
+    for pattern, negate, anchored, dir_only in patterns:
+        if dir_only and not is_dir:
+            continue
+        if pattern.fullmatch(path if anchored else name):
+            result = not negate
+    return result
+
+
+def fetch_archive(client, container, path):
+    """
+    Fetch the archive of a path in the container.
+
+    Args:
+        container (str): The id of the container.
+        path (str): The absolute path to fetch.
+
+    Returns:
+        .io.BytesIO: The tar archive of the path.
+
+    """
+    response = client.get_archive(container, path)[0]
+    if hasattr(response, 'read'):
+        return io.BytesIO(response.read())
+    # Newer docker clients stream the archive in chunks.
+    return io.BytesIO(b''.join(response))
+
+
+def fingerprint(*parts):
+    """
+    Fingerprint data.
+
+    Args:
+        *parts: The data to fingerprint. Parts are `bytes` or serialisable to
+            JSON.
+
+    Returns:
+        str: The fingerprint.
+
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True).encode()
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def finish_env(client, container, env, logger, record=None):
+    """
+    Finish running an environment.
+
+    Run the `pull` and `after` entries of the environment.
+
+    Args:
+        container (str): The id of the container.
+        env (dict): The environment to finish.
+
+    Keyword Args:
+        record (.EnvRecord): The record of the environment.
+
+    """
+    if 'pull' in env:
+        pull(client, container, env['pull'], logger, record=record)
+
+    if 'after' in env:
+        run_env(client, container, env['after'], logger, record=record)
+
+
+def format_trend(durations):
+    """
+    Format the trend of durations.
+
+    The latest duration is compared to the average of the ones before it.
+    Increases of more than `HISTORY_REGRESSION` are marked as a regression.
+
+    Args:
+        durations (list): The durations (`float`), the latest first.
+
+    Returns:
+        str: The formatted trend.
+
+    """
+    latest = durations[0]
+    trend = '{:.1f}s'.format(latest)
+    previous = durations[1:]
+    if previous:
+        average = sum(previous) / len(previous)
+        change = (latest - average) / average if average else 0
+        trend += ' (average {:.1f}s, {:+.0%})'.format(average, change)
+        if change > HISTORY_REGRESSION:
+            trend += ' REGRESSION'
+    return trend
+
+
+def init_client(base_url=None):
+    """
+    Initialise the docker client.
+
+    Keyword Args:
+        base_url (str): The URL of the docker daemon. When omitted the daemon
+            is configured by the environment.
+
+    Returns:
+        .docker.APIClient: The docker client.
+
+    """
+    if base_url:
+        return docker.APIClient(base_url=base_url)
+    return docker.APIClient()
+
+
+def init_hosts(hosts):
     """
-    Initialise the docker client.
+    Initialise the docker hosts.
+
+    Args:
+        hosts (list): The `hosts` entry of the config. An entry is either the
+            URL of a daemon or a dict with the `url` and optionally the
+            `capacity` of the host. The capacity defaults to the number of
+            CPUs of the host.
 
     Returns:
-        .docker.APIClient: The docker client.
+        list: The hosts (`.Host`).
 
     """
-    return docker.APIClient()
+    initialised = []
+    for host in hosts:
+        if not isinstance(host, dict):
+            host = {'url': host}
+        client = init_client(host['url'])
+        capacity = host.get('capacity') or client.info()['NCPU']
+        initialised.append(Host(client, capacity, url=host['url']))
+    return initialised
 
 
-def init_logger(level=logging.INFO):
+def init_logger(level=logging.INFO, log_dir=None):
     """
     Initialise the logger.
 
     Configure and initialise a logger. The logger is configured to log at the
     given level. Newlines are omitted so no double newlines are logged.
-    The logger is configured to log to stdout.
+
+    The records are queued and written to stderr by a `LogWriter` in the
+    background, so logging doesn't block on the terminal. The writer is
+    stopped, writing the remaining records, when moby exits.
 
     Args:
         level (int): The level the logger should log on.
 
+    Keyword Args:
+        log_dir (str): The directory to write log files to.
+
     Returns:
         .logging.Logger: The initialised logger.
 
@@ -80,18 +1274,36 @@ def init_logger(level=logging.INFO):
     logger = logging.getLogger(__name__)
     logger.setLevel(level)
 
-    handler = logging.StreamHandler()
-    handler.setLevel(level)
-    handler.terminator = ''
+    records = queue.Queue()
+    writer = LogWriter(records, sys.stderr, level=level, log_dir=log_dir)
+    writer.start()
+    atexit.register(writer.stop)
 
-    formatter = logging.Formatter('%(message)s')
-    handler.setFormatter(formatter)
+    handler = logging.handlers.QueueHandler(records)
+    handler.setLevel(level)
 
     logger.addHandler(handler)
 
     return logger
 
 
+def list_dir(path):
+    """
+    List a directory.
+
+    Args:
+        path (str): The directory to list.
+
+    Returns:
+        list: Tuples of the path (`str`) of every entry and whether it is a
+            directory (`bool`), sorted by path.
+
+    """
+    return sorted(
+        (entry.path, entry.is_dir(follow_symlinks=False))
+        for entry in os.scandir(path))
+
+
 def load_config():
     """
     Load the moby config.
@@ -107,7 +1319,360 @@ def load_config():
     return config
 
 
-def pull(client, container, files, logger):
+def load_excludes(exclude=None, ignore_files=None):
+    """
+    Load the exclude patterns.
+
+    The patterns are read from the ignore files, followed by the extra
+    patterns. They follow the `.gitignore` format: a pattern without a slash
+    matches a name at any depth, other patterns match the path relative to
+    the current directory. A trailing slash only matches directories and a
+    leading `!` negates the pattern. See `compile_pattern` for the wildcards.
+
+    Like docker does, the patterns of a `.dockerignore` file always match the
+    path relative to the current directory.
+
+    Keyword Args:
+        exclude (list): Extra patterns (`str`).
+        ignore_files (list): The paths (`str`) of the ignore files. Files
+            that don't exist are skipped.
+
+    Returns:
+        list: The parsed patterns as tuples of the compiled pattern (see
+            `compile_pattern`) and whether it is negated, anchored and only
+            matches directories (`bool`).
+
+    """
+    lines = []
+    for ignore_file in ignore_files or []:
+        if os.path.isfile(ignore_file):
+            anchored = os.path.basename(ignore_file) == '.dockerignore'
+            with open(ignore_file, 'r') as ignore:
+                lines.extend(
+                    (line, anchored) for line in ignore.read().splitlines())
+    lines.extend((line, False) for line in exclude or [])
+    patterns = []
+    for line, anchored in lines:
+        pattern = line.strip()
+        if not pattern or pattern.startswith('#'):
+            continue
+        negate = pattern.startswith('!')
+        pattern = pattern.lstrip('!')
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = anchored or '/' in pattern
+        pattern = pattern.lstrip('/')
+        if pattern.startswith('./'):
+            pattern = pattern[2:]
+        if pattern:
+            patterns.append(
+                (compile_pattern(pattern), negate, anchored, dir_only))
+    return patterns
+
+
+def load_journal(path, build):
+    """
+    Load the journal of the failed run to resume.
+
+    Args:
+        path (str): The path of the journal file.
+        build (str): The fingerprint of the current build, see
+            `build_fingerprint`.
+
+    Returns:
+        .Journal: The loaded journal. `None` if there is no journal file, or
+            if the run can't be resumed because the build changed or no
+            container was committed.
+
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as journal:
+        journal = json.load(journal)
+    if journal['build'] != build or not journal['image']:
+        return None
+    return Journal(
+        path,
+        build=journal['build'],
+        image=journal['image'],
+        completed=journal['steps'])
+
+
+def log_name(kind, name):
+    """
+    Name a log file.
+
+    Unsafe characters in the name are replaced and long names are cut. When
+    that changes the name, a short hash of the name is appended, so different
+    names get different log files. Dots only separate the parts of a name.
+
+    Args:
+        kind (str): The kind of the log file, which prefixes the name.
+        name (str): The name, e.g. of an environment or a command.
+
+    Returns:
+        str: The name of the log file, without extension.
+
+    """
+    safe = UNSAFE_FILENAME.sub('_', name).strip('_')[:100]
+    if safe != name:
+        safe = '{}-{}'.format(safe, fingerprint(name)[:8])
+    return '{}-{}'.format(kind, safe)
+
+
+def make_archive(files, exclude=None, ignore_files=None):
+    """
+    Create a tar archive of files.
+
+    Directories are added recursively, except for the entries that match an
+    exclude pattern (see `load_excludes`). The files themselves are never
+    excluded.
+
+    Directories are listed and files are read in batches on a thread pool,
+    ahead of adding them to the archive in order.
+
+    Args:
+        files (list): A list of filenames (`str`) to archive.
+
+    Keyword Args:
+        exclude (list): Extra exclude patterns (`str`).
+        ignore_files (list): The ignore files (`str`) to read exclude
+            patterns from.
+
+    Returns:
+        bytes: The tar archive.
+
+    """
+    patterns = load_excludes(exclude, ignore_files=ignore_files)
+    archive_file = io.BytesIO()
+    archive = tarfile.open(fileobj=archive_file, mode='w')
+    with concurrent.futures.ThreadPoolExecutor(SCAN_WORKERS) as executor:
+        pending = collections.deque()
+        batch = []
+        for path in files:
+            for entry in walk(executor, path, patterns):
+                batch.append(entry)
+                if len(batch) < SCAN_BATCH:
+                    continue
+                pending.append(executor.submit(read_files, batch))
+                batch = []
+                if len(pending) >= SCAN_WINDOW:
+                    add_files(archive, pending.popleft().result())
+        pending.append(executor.submit(read_files, batch))
+        while pending:
+            add_files(archive, pending.popleft().result())
+    archive.close()
+    return archive_file.getvalue()
+
+
+def make_tarinfo(path, status):
+    """
+    Create the tar header of a file.
+
+    Like `.tarfile.TarFile.gettarinfo`, but from the status of the file and
+    without an archive, so headers can be created on a thread pool. Hard
+    links are detected by `add_files`.
+
+    Args:
+        path (str): The path of the file.
+        status (.os.stat_result): The status of the file, see `.os.lstat`.
+
+    Returns:
+        .tarfile.TarInfo: The header. `None` if the type of the file can't be
+            archived, e.g. a socket.
+
+    """
+    mode = status.st_mode
+    tarinfo = tarfile.TarInfo(
+        os.path.splitdrive(path)[1].replace(os.sep, '/').lstrip('/'))
+    if stat.S_ISREG(mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = status.st_size
+    elif stat.S_ISDIR(mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        tarinfo.type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(path)
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        tarinfo.type = (
+            tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE)
+        tarinfo.devmajor = os.major(status.st_rdev)
+        tarinfo.devminor = os.minor(status.st_rdev)
+    else:
+        return None
+    tarinfo.mode = mode
+    tarinfo.uid = status.st_uid
+    tarinfo.gid = status.st_gid
+    tarinfo.mtime = status.st_mtime
+    if pwd:
+        try:
+            tarinfo.uname = pwd.getpwuid(status.st_uid)[0]
+        except KeyError:
+            pass
+    if grp:
+        try:
+            tarinfo.gname = grp.getgrgid(status.st_gid)[0]
+        except KeyError:
+            pass
+    return tarinfo
+
+
+def measure_resources(record, samples):
+    """
+    Measure the resource usage of an environment.
+
+    The resources used by the environment and by each of its commands are
+    summarised (see `summarize_samples`) and stored in the record.
+
+    Args:
+        record (.EnvRecord): The record of the environment.
+        samples (list): The samples of the container the environment ran in.
+
+    """
+    record.resources = summarize_samples(
+        samples, record.started, record.finished)
+    for command in record.commands:
+        command['resources'] = summarize_samples(
+            samples, command['started'], command['finished'])
+
+
+def open_history(path):
+    """
+    Open the history database.
+
+    The database is created if it doesn't exist yet.
+
+    Args:
+        path (str): The path of the database.
+
+    Returns:
+        .sqlite3.Connection: The history database.
+
+    """
+    history = sqlite3.connect(path)
+    history.executescript(HISTORY_SCHEMA)
+    return history
+
+
+def order_envs(names, durations):
+    """
+    Order environments longest first.
+
+    Environments without an estimated duration are put first, as they may
+    take long as well.
+
+    Args:
+        names (list): The names (`str`) of the environments.
+        durations (dict): The estimated durations, see `estimate_durations`.
+
+    Returns:
+        list: The ordered names.
+
+    """
+    return sorted(
+        names, key=lambda name: -durations.get(name, float('inf')))
+
+
+def parse_args(args=None):
+    """
+    Parse the command line arguments.
+
+    Args:
+        args (list): The arguments to parse, defaults to `sys.argv`.
+
+    Returns:
+        .argparse.Namespace: The parsed arguments.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='moby',
+        description='Automate running commands in docker.')
+    parser.add_argument(
+        '--history',
+        action='store_true',
+        help='report the durations of previous runs and exit')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='resume the failed run, skipping the steps that completed')
+    return parser.parse_args(args)
+
+
+def parse_stats(stats):
+    """
+    Parse a sample of the docker stats API.
+
+    Args:
+        stats (dict): The decoded stats.
+
+    Returns:
+        dict: The CPU usage as a percentage of a single CPU (`cpu`), the
+            memory usage without the page cache (`memory`) and the memory
+            limit (`memory_limit`) in bytes, and the total number of bytes
+            read and written (`block_io`) and received and sent (`network`).
+
+    """
+    cpu = stats.get('cpu_stats', {})
+    precpu = stats.get('precpu_stats', {})
+    cpu_delta = (
+        cpu.get('cpu_usage', {}).get('total_usage', 0) -
+        precpu.get('cpu_usage', {}).get('total_usage', 0))
+    system_delta = (
+        cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0))
+    cpus = cpu.get('online_cpus') or len(
+        cpu.get('cpu_usage', {}).get('percpu_usage') or [None])
+    cpu_percent = 0.0
+    if precpu.get('system_cpu_usage') and system_delta > 0:
+        cpu_percent = 100.0 * cpu_delta / system_delta * cpus
+
+    memory = stats.get('memory_stats', {})
+    cache = memory.get('stats', {})
+    cache = cache.get('total_inactive_file', cache.get('inactive_file', 0))
+    io_service_bytes = stats.get('blkio_stats', {}).get(
+        'io_service_bytes_recursive') or []
+    networks = (stats.get('networks') or {}).values()
+    return {
+        'cpu': cpu_percent,
+        'memory': max(memory.get('usage', 0) - cache, 0),
+        'memory_limit': memory.get('limit', 0),
+        'block_io': sum(
+            entry.get('value', 0) for entry in io_service_bytes
+            if entry.get('op', '').lower() in ('read', 'write')),
+        'network': sum(
+            network.get('rx_bytes', 0) + network.get('tx_bytes', 0)
+            for network in networks),
+    }
+
+
+def prepare_env(executor, client, image, env, logger):
+    """
+    Prepare an environment in the background.
+
+    Start a container for the environment and create the archive of its
+    `push` entry using the executor.
+
+    Args:
+        executor (.concurrent.futures.Executor): The executor to use.
+        image (str): The id of the image.
+        env (dict): The environment to prepare.
+
+    Returns:
+        tuple: A future of the container id and a future of the archive. The
+            archive future is `None` when the environment has no `push` entry.
+
+    """
+    container = executor.submit(start_container, client, image, logger)
+    archive = None
+    if 'push' in env:
+        archive = executor.submit(
+            make_archive, env['push'], exclude=env.get('exclude'),
+            ignore_files=env.get('ignore_files'))
+    return container, archive
+
+
+def pull(client, container, files, logger, record=None):
     """
     Pull files from the container.
 
@@ -115,22 +1680,65 @@ def pull(client, container, files, logger):
     Filenames can be relative or absolute, if relative they are expected to be
     relative to the current working dir of the container.
 
+    The archives of the files are fetched concurrently and extracted in the
+    order of the files.
+
     Args:
         container (str): The id of the container.
         files (list): A list of filenames (`str`) to download.
 
+    Keyword Args:
+        record (.EnvRecord): The record to add the pulled bytes to.
+
     """
-    cwd = run_command(client, container, 'pwd', logger, silent=True)
-    for path in files:
-        if not path.startswith('/'):
-            path = posixpath.join(cwd, path)
-        response = client.get_archive(container, path)[0]
-        archive_file = io.BytesIO(response.read())
-        archive = tarfile.open(fileobj=archive_file, mode='r')
-        archive.extractall()
+    if record and record.skip('pull', list(files)):
+        logger.info(BOLD.format('Skipping pull, it completed before.\n'))
+        return
+    paths = list(files)
+    if not all(path.startswith('/') for path in paths):
+        cwd = run_command(client, container, 'pwd', logger, silent=True)
+        paths = [posixpath.join(cwd, path) for path in paths]
+    fetch = functools.partial(fetch_archive, client, container)
+    with concurrent.futures.ThreadPoolExecutor(PULL_WORKERS) as executor:
+        for archive_file in executor.map(fetch, paths):
+            if record:
+                record.pulled += len(archive_file.getvalue())
+            archive = tarfile.open(fileobj=archive_file, mode='r')
+            archive.extractall()
+    if record:
+        record.complete()
+
+
+def pull_cache(client, cache, logger):
+    """
+    Pull the images to use as layer cache.
+
+    Images that can't be pulled, e.g. because they were never pushed, are
+    skipped.
 
+    Args:
+        cache (dict): The `cache` entry of the config.
+
+    Returns:
+        list: The names (`str`) of the images that were pulled.
 
-def push(client, container, files, logger):
+    """
+    logger.info(BOLD.format('Pulling cache...\n'))
+    pulled = []
+    for image in cache_images(cache):
+        repository, tag = docker.utils.parse_repository_tag(image)
+        try:
+            output = client.pull(repository, tag=tag, stream=True)
+            check_stream(output, logger)
+        except docker.errors.DockerException as error:
+            logger.warning('Not using {} as cache: {}\n'.format(image, error))
+        else:
+            pulled.append(image)
+    return pulled
+
+
+def push(client, container, files, logger, archive=None, exclude=None,
+         ignore_files=None, record=None):
     """
     Push files to the container.
 
@@ -140,16 +1748,223 @@ def push(client, container, files, logger):
         container (str): The id of the container.
         files (list): A list of filenames (`str`) to upload.
 
+    Keyword Args:
+        archive (bytes): A tar archive of the files, as created by
+            `make_archive`. When omitted the archive is created here.
+        exclude (list): Extra exclude patterns (`str`) for `make_archive`.
+        ignore_files (list): The ignore files (`str`) for `make_archive`.
+        record (.EnvRecord): The record to add the pushed bytes to.
+
     """
+    if archive is None:
+        archive = make_archive(
+            files, exclude=exclude, ignore_files=ignore_files)
+    if record and record.journal is not None and record.skip(
+            'push', list(files), archive_fingerprint(archive)):
+        logger.info(BOLD.format('Skipping push, it completed before.\n'))
+        return
     cwd = run_command(client, container, 'pwd', logger, silent=True)
-    archive_file = io.BytesIO()
-    archive = tarfile.open(fileobj=archive_file, mode='w')
-    for path in files:
-        archive.add(path)
-    client.put_archive(container, cwd, archive_file.getvalue())
+    client.put_archive(container, cwd, archive)
+    if record:
+        record.pushed += len(archive)
+        record.complete()
+
+
+def push_cache(client, image, cache, logger):
+    """
+    Push the layer cache.
+
+    The built image is tagged as the first cache image. Then all cache images
+    are pushed, so the next build can use them. Failing to tag or push is
+    logged but doesn't fail the build.
+
+    Args:
+        image (str): The id of the built image.
+        cache (dict): The `cache` entry of the config.
+
+    """
+    images = cache_images(cache)
+    if not images:
+        return
+    logger.info(BOLD.format('Pushing cache...\n'))
+    for index, cache_image in enumerate(images):
+        repository, tag = docker.utils.parse_repository_tag(cache_image)
+        try:
+            if index == 0:
+                client.tag(image, repository, tag=tag)
+            output = client.push(repository, tag=tag, stream=True)
+            check_stream(output, logger)
+        except docker.errors.DockerException as error:
+            logger.warning(
+                'Failed to push {}: {}\n'.format(cache_image, error))
+
+
+def read_files(paths):
+    """
+    Read files ahead of adding them to an archive.
+
+    The status and tar header (see `make_tarinfo`) of every file are read.
+    Only regular files up to `SCAN_READ_LIMIT` bytes are read, bigger files
+    are streamed into the archive by `add_files`.
+
+    Args:
+        paths (list): The paths (`str`) of the files.
+
+    Returns:
+        list: Tuples of the path, the status (`.os.stat_result`), the header
+            (`.tarfile.TarInfo`) and the contents (`bytes`) of every file.
+            The contents are `None` if the file wasn't read.
+
+    """
+    files = []
+    for path in paths:
+        status = os.lstat(path)
+        data = None
+        if stat.S_ISREG(status.st_mode) and \
+                status.st_size <= SCAN_READ_LIMIT:
+            with open(path, 'rb') as fileobj:
+                data = fileobj.read()
+        files.append((path, status, make_tarinfo(path, status), data))
+    return files
+
+
+def release_host(condition, host, future):
+    """
+    Release a host after it ran an environment.
+
+    Args:
+        condition (.threading.Condition): The condition to notify.
+        host (.Host): The host that ran the environment.
+        future (.concurrent.futures.Future): The future of the environment.
+
+    """
+    with condition:
+        host.running -= 1
+        condition.notify_all()
+
+
+def remove_resume_images(client, logger):
+    """
+    Remove the images committed to resume failed runs.
 
+    Only the images committed in the current directory are removed. Images
+    that can't be removed are logged and kept.
 
-def run_command(client, container, command, logger, silent=False):
+    """
+    images = client.images(
+        all=True, quiet=True,
+        filters={'label': '{}={}'.format(RESUME_LABEL, os.getcwd())})
+    for image in images:
+        try:
+            client.remove_image(image, force=True)
+        except docker.errors.NotFound:
+            # Removing a child image removed its parent as well.
+            pass
+        except docker.errors.DockerException as error:
+            logger.warning('Failed to remove {}: {}\n'.format(image, error))
+
+
+def report_history(history, logger):
+    """
+    Report the history of the environments.
+
+    For every environment the latest duration is compared to the average of
+    the runs before it, for the environment and for the commands of its
+    latest run.
+
+    Args:
+        history (.sqlite3.Connection): The history database.
+
+    """
+    names = [
+        row[0] for row in history.execute(
+            'SELECT DISTINCT name FROM envs ORDER BY name')
+    ]
+    if not names:
+        logger.info('No history recorded yet.\n')
+        return
+    for name in names:
+        rows = history.execute(
+            'SELECT run, duration, exit_code, pushed, pulled FROM envs '
+            'WHERE name = ? ORDER BY run DESC LIMIT ?',
+            (name, HISTORY_RUNS + 1)).fetchall()
+        run, _, exit_code, pushed, pulled = rows[0]
+        logger.info(BOLD.format(name) + ': {}, exit code {}, pushed {} bytes, '
+                    'pulled {} bytes\n'.format(
+                        format_trend([row[1] for row in rows]),
+                        exit_code, pushed, pulled))
+        commands = history.execute(
+            'SELECT DISTINCT command FROM commands WHERE env = ? AND run = ?',
+            (name, run)).fetchall()
+        for command, in commands:
+            durations = history.execute(
+                'SELECT duration FROM commands WHERE env = ? AND command = ? '
+                'ORDER BY run DESC LIMIT ?',
+                (name, command, HISTORY_RUNS + 1)).fetchall()
+            logger.info('  {!r}: {}\n'.format(
+                command, format_trend([row[0] for row in durations])))
+
+
+def report_resources(records, config, logger):
+    """
+    Report the resource usage of the environments.
+
+    The usage of every environment is logged. A warning is logged for
+    environments of which the peak memory usage exceeds `memory_warning`
+    times the memory limit, or of which the average CPU usage is below
+    `idle_warning` percent. With `output` the usage of the environments and
+    their commands is written to that JSON file.
+
+    Args:
+        records (list): The records (`.EnvRecord`) of the environments.
+        config (dict): The `resources` entry of the config.
+
+    """
+    memory_warning = config.get('memory_warning', RESOURCE_MEMORY_WARNING)
+    idle_warning = config.get('idle_warning', RESOURCE_IDLE_WARNING)
+    logger.info(BOLD.format('Resource usage:\n'))
+    for record in records:
+        usage = record.resources
+        if usage is None:
+            logger.info('{}: no samples\n'.format(record.name))
+            continue
+        logger.info(
+            '{}: CPU {:.0f}% average, {:.0f}% peak; memory {:.1f} MiB '
+            'average, {:.1f} MiB peak; block I/O {:.1f} MiB; network '
+            '{:.1f} MiB\n'.format(
+                record.name, usage['cpu_avg'], usage['cpu_peak'],
+                usage['memory_avg'] / 2 ** 20, usage['memory_peak'] / 2 ** 20,
+                usage['block_io'] / 2 ** 20, usage['network'] / 2 ** 20))
+        limit = usage['memory_limit']
+        if limit and usage['memory_peak'] > memory_warning * limit:
+            logger.warning(
+                '{} used {:.0%} of its memory limit.\n'.format(
+                    record.name, usage['memory_peak'] / limit))
+        if usage['cpu_avg'] < idle_warning:
+            logger.warning(
+                '{} was mostly idle, its average CPU usage was '
+                '{:.1f}%.\n'.format(record.name, usage['cpu_avg']))
+    if config.get('output'):
+        output = [
+            {
+                'name': record.name,
+                'resources': record.resources,
+                'commands': [
+                    {
+                        'command': command['command'],
+                        'resources': command.get('resources'),
+                    }
+                    for command in record.commands
+                ],
+            }
+            for record in records
+        ]
+        with open(config['output'], 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+
+
+def run_command(client, container, command, logger, silent=False,
+                record=None):
     """
     Run a command in a running container.
 
@@ -159,6 +1974,7 @@ def run_command(client, container, command, logger, silent=False):
 
     Keyword Args:
         silent (bool): Whether or not to suppress logging.
+        record (.EnvRecord): The record to add the command to.
 
     Returns:
         str: The output of the command.
@@ -168,8 +1984,16 @@ def run_command(client, container, command, logger, silent=False):
             same exit code.
 
     """
+    extra = {'command': command}
+    if record and record.skip('run', command):
+        logger.info(BOLD.format(
+            'Skipping {!r}, it completed before.\n'.format(command)),
+            extra=extra)
+        return ''
+    started = time.monotonic()
     if not silent:
-        logger.info(BOLD.format('Running {!r}:\n'.format(command)))
+        logger.info(
+            BOLD.format('Running {!r}:\n'.format(command)), extra=extra)
     command = client.exec_create(
         container,
         command)
@@ -181,15 +2005,65 @@ def run_command(client, container, command, logger, silent=False):
         line = line.decode()
         out.write(line)
         if not silent:
-            logger.info(line)
+            logger.info(line, extra=extra)
     command = client.exec_inspect(command)
     exit_code = command['ExitCode']
+    if record:
+        record.add_command(extra['command'], started, exit_code)
     if exit_code:
         raise SystemExit(exit_code)
+    if record:
+        record.complete()
     return out.getvalue().strip()
 
 
-def run_env(client, container, env, logger):
+def run_distributed(hosts, config, logger, records=None):
+    """
+    Run the environments distributed over hosts.
+
+    Every environment is run in a container of its own, on the host with the
+    most free capacity. When all hosts are at capacity, the next environment
+    waits for a host to finish an environment. After an environment fails, no
+    new environments are started. Pulled files are stored locally.
+
+    Args:
+        hosts (list): The hosts (`.Host`), with their images built.
+        config (dict): The moby config.
+
+    Keyword Args:
+        records (list): A list to append the records (`.EnvRecord`) of the
+            environments to.
+
+    """
+    if records is None:
+        records = []
+    condition = threading.Condition()
+    futures = []
+    executor = concurrent.futures.ThreadPoolExecutor(
+        sum(host.capacity for host in hosts))
+    with executor:
+        for name in config['envlist']:
+            with condition:
+                condition.wait_for(lambda: any_failed(futures) or any(
+                    host.free > 0 for host in hosts))
+                if any_failed(futures):
+                    break
+                host = max(hosts, key=lambda host: host.free)
+                host.running += 1
+            record = EnvRecord(name)
+            records.append(record)
+            future = executor.submit(
+                run_on_host, host, config[name],
+                StreamLogger(logger, name, prefix=True), record,
+                sample=bool(config.get('resources')))
+            future.add_done_callback(
+                functools.partial(release_host, condition, host))
+            futures.append(future)
+    for future in futures:
+        future.result()
+
+
+def run_env(client, container, env, logger, record=None):
     """
     Run an environment.
 
@@ -205,21 +2079,221 @@ def run_env(client, container, env, logger):
         container (str): The id of the container.
         env (dict): The environment to run.
 
+    Keyword Args:
+        record (.EnvRecord): The record of the environment.
+
     """
-    if 'before' in env:
-        run_env(client, container, env['before'], logger)
+    begin_env(client, container, env, logger, record=record)
+    finish_env(client, container, env, logger, record=record)
 
-    if 'push' in env:
-        push(client, container, env['push'], logger)
 
-    for command in env.get('run', []):
-        run_command(client, container, command, logger)
+def run_on_host(host, env, logger, record, sample=False):
+    """
+    Run an environment in a container of its own on a host.
 
-    if 'pull' in env:
-        pull(client, container, env['pull'], logger)
+    Args:
+        host (.Host): The host to run the environment on.
+        env (dict): The environment to run.
+        record (.EnvRecord): The record of the environment.
 
-    if 'after' in env:
-        run_env(client, container, env['after'], logger)
+    Keyword Args:
+        sample (bool): Whether to sample the resource usage of the container.
+
+    """
+    container = start_container(host.client, host.image, logger)
+    sampler = None
+    if sample:
+        sampler = ResourceSampler(host.client, container)
+        sampler.start()
+    try:
+        run_env(host.client, container, env, logger, record=record)
+    except BaseException:
+        record.fail()
+        raise
+    finally:
+        record.finish()
+        stop_container(host.client, container, logger)
+        if sampler:
+            sampler.stop()
+            measure_resources(record, sampler.samples)
+
+
+def run_pipeline(client, image, config, logger, records=None):
+    """
+    Run the environments in a pipeline.
+
+    Every environment is run in a container of its own. While an environment
+    runs, the container of the next environment is started and the archive of
+    its `push` entry is prepared. The `pull` and `after` entries of an
+    environment and stopping its container are done in the background while
+    the next environment runs. After an environment fails, no new
+    environments are begun.
+
+    Args:
+        image (str): The id of the image.
+        config (dict): The moby config.
+
+    Keyword Args:
+        records (list): A list to append the records (`.EnvRecord`) of the
+            environments to. When the `resources` entry is configured the
+            containers are sampled and the usage is stored in the records.
+
+    """
+    envs = [config[name] for name in config['envlist']]
+    if not envs:
+        return
+    if records is None:
+        records = []
+    loggers = [
+        StreamLogger(logger, name, prefix=True) for name in config['envlist']
+    ]
+    executor = concurrent.futures.ThreadPoolExecutor(PIPELINE_WORKERS)
+    starting = []
+    finishing = []
+    recorded = []
+    samplers = []
+    with executor:
+        try:
+            upcoming = prepare_env(
+                executor, client, image, envs[0], loggers[0])
+            starting.append(upcoming[0])
+            for index, env in enumerate(envs):
+                container, archive = upcoming
+                container = container.result()
+                if config.get('resources'):
+                    samplers.append(ResourceSampler(client, container))
+                    samplers[-1].start()
+                if index + 1 < len(envs):
+                    upcoming = prepare_env(
+                        executor, client, image, envs[index + 1],
+                        loggers[index + 1])
+                    starting.append(upcoming[0])
+                if archive is not None:
+                    archive = archive.result()
+                if any_failed(finishing):
+                    break
+                record = EnvRecord(config['envlist'][index])
+                records.append(record)
+                recorded.append(record)
+                begin_env(
+                    client, container, env, loggers[index], archive=archive,
+                    record=record)
+                finishing.append(executor.submit(
+                    complete_env, client, container, env, loggers[index],
+                    record=record))
+            for future in finishing:
+                future.result()
+        finally:
+            for record in recorded[len(finishing):]:
+                record.fail()
+                record.finish()
+            concurrent.futures.wait(starting + finishing)
+            for index in range(len(finishing), len(starting)):
+                if starting[index].exception() is None:
+                    stop_container(
+                        client, starting[index].result(), loggers[index])
+            for sampler in samplers:
+                sampler.stop()
+            for sampler, record in zip(samplers, recorded):
+                measure_resources(record, sampler.samples)
+
+
+def run_serial(client, image, config, logger, records=None, journal=None):
+    """
+    Run the environments one after another in a single container.
+
+    Args:
+        image (str): The id of the image.
+        config (dict): The moby config.
+
+    Keyword Args:
+        records (list): A list to append the records (`.EnvRecord`) of the
+            environments to. When the `resources` entry is configured the
+            container is sampled and the usage is stored in the records.
+        journal (.Journal): The journal of the run. When the run fails, the
+            container is committed so the run can be resumed. When it
+            succeeds, the journal and the images to resume from are removed.
+
+    """
+    if records is None:
+        records = []
+    container = start_container(client, image, logger)
+    sampler = None
+    if config.get('resources'):
+        sampler = ResourceSampler(client, container)
+        sampler.start()
+    recorded = []
+
+    try:
+        for env in config['envlist']:
+            record = EnvRecord(env, journal=journal)
+            records.append(record)
+            recorded.append(record)
+            try:
+                run_env(
+                    client, container, config[env], StreamLogger(logger, env),
+                    record=record)
+            except BaseException:
+                record.fail()
+                raise
+            finally:
+                record.finish()
+    except ResumeError:
+        raise
+    except BaseException:
+        if journal is not None:
+            try:
+                commit_container(client, container, journal, logger)
+            except Exception as error:
+                # Failing to commit mustn't hide why the run failed.
+                logger.warning(
+                    'Failed to commit the container: {}\n'.format(error))
+        raise
+    finally:
+        stop_container(client, container, logger)
+        if sampler:
+            sampler.stop()
+            for record in recorded:
+                measure_resources(record, sampler.samples)
+    if journal is not None:
+        journal.remove()
+        remove_resume_images(client, logger)
+
+
+def save_history(history, records):
+    """
+    Save the records of a run to the history.
+
+    Records of resumed environments are left out.
+
+    Args:
+        history (.sqlite3.Connection): The history database.
+        records (list): The records (`.EnvRecord`) of the environments.
+
+    """
+    records = [record for record in records if not record.resumed]
+    if not records:
+        return
+    with history:
+        run = history.execute(
+            'INSERT INTO runs (started) VALUES (?)',
+            (time.time(),)).lastrowid
+        history.executemany(
+            'INSERT INTO envs VALUES (?, ?, ?, ?, ?, ?)',
+            [
+                (run, record.name, record.duration, record.pushed,
+                 record.pulled, record.exit_code)
+                for record in records
+            ])
+        history.executemany(
+            'INSERT INTO commands VALUES (?, ?, ?, ?, ?)',
+            [
+                (run, record.name, command['command'],
+                 command['finished'] - command['started'],
+                 command['exit_code'])
+                for record in records
+                for command in record.commands
+            ])
 
 
 def start_container(client, image, logger):
@@ -257,6 +2331,106 @@ def stop_container(client, container, logger):
     client.stop(container)
 
 
+def summarize_samples(samples, started, finished):
+    """
+    Summarise the samples taken during a window.
+
+    Args:
+        samples (list): The samples, see `parse_stats`.
+        started (float): The `time.monotonic` the window started at.
+        finished (float): The `time.monotonic` the window finished at.
+
+    Returns:
+        dict: The average and peak CPU and memory usage, the memory limit and
+            the number of bytes of block and network I/O during the window.
+            `None` when no samples were taken during the window.
+
+    """
+    window = [
+        sample for sample in samples if started <= sample['time'] <= finished
+    ]
+    if not window:
+        return None
+    before = [sample for sample in samples if sample['time'] < started]
+    baseline = before[-1] if before else window[0]
+    return {
+        'samples': len(window),
+        'cpu_avg': sum(sample['cpu'] for sample in window) / len(window),
+        'cpu_peak': max(sample['cpu'] for sample in window),
+        'memory_avg': sum(
+            sample['memory'] for sample in window) / len(window),
+        'memory_peak': max(sample['memory'] for sample in window),
+        'memory_limit': window[-1]['memory_limit'],
+        'block_io': window[-1]['block_io'] - baseline['block_io'],
+        'network': window[-1]['network'] - baseline['network'],
+    }
+
+
+def walk(executor, path, patterns):
+    """
+    Walk a path.
+
+    Yield the path and, if it is a directory, everything below it that isn't
+    excluded, depth first and sorted by name. The subdirectories of a
+    directory are listed ahead on the executor.
+
+    Args:
+        executor (.concurrent.futures.Executor): The executor to list
+            directories on.
+        path (str): The path to walk.
+        patterns (list): The exclude patterns, see `load_excludes`.
+
+    Yields:
+        str: The paths.
+
+    """
+    yield path
+    if os.path.isdir(path) and not os.path.islink(path):
+        # Directories are walked using a stack instead of recursion, so deep
+        # trees don't hit the recursion limit.
+        listing = executor.submit(list_dir, path)
+        stack = [walk_listing(executor, listing, patterns)]
+        while stack:
+            for entry, listing in stack[-1]:
+                yield entry
+                if listing is not None:
+                    stack.append(walk_listing(executor, listing, patterns))
+                    break
+            else:
+                stack.pop()
+
+
+def walk_listing(executor, listing, patterns):
+    """
+    Walk the listing of a directory.
+
+    Listing the subdirectories is submitted to the executor at once, so they
+    are listed by the time they are walked.
+
+    Args:
+        executor (.concurrent.futures.Executor): The executor to list
+            directories on.
+        listing (.concurrent.futures.Future): The listing of the directory,
+            see `list_dir`.
+        patterns (list): The exclude patterns, see `load_excludes`.
+
+    Yields:
+        tuple: The path (`str`) of every entry that isn't excluded and the
+            future of its listing, `None` if it isn't a directory.
+
+    """
+    entries = [
+        (path, is_dir) for path, is_dir in listing.result()
+        if not excluded(path, is_dir, patterns)
+    ]
+    listings = [
+        executor.submit(list_dir, path) if is_dir else None
+        for path, is_dir in entries
+    ]
+    for (path, _), listing in zip(entries, listings):
+        yield path, listing
+
+
 def main():
     """
     The main entry point of moby.
@@ -264,17 +2438,85 @@ def main():
     This function ties it all together.
 
     """
-    logger = init_logger()
-    config = load_config()
-    client = init_client()
-    image = build_image(client, logger)
-    container = start_container(client, image, logger)
-
+    args = parse_args()
+    config = exclude_own_files(load_config())
+    logger = init_logger(log_dir=config.get('log_dir'))
+    history = config.get('history', HISTORY_FILE)
+    if history:
+        history = open_history(history)
+    if args.history:
+        if history:
+            report_history(history, logger)
+        else:
+            logger.info('The history is disabled.\n')
+        return
+
+    hosts = None
+    if config.get('hosts'):
+        hosts = init_hosts(config['hosts'])
+
+    if history:
+        durations = estimate_durations(history, config['envlist'])
+        slots = 1
+        if hosts:
+            # Only hosts run environments at once, so only then running the
+            # longest first shortens the run.
+            config = dict(
+                config, envlist=order_envs(config['envlist'], durations))
+            slots = sum(host.capacity for host in hosts)
+        if durations:
+            logger.info('Estimated runtime: {}{:.1f}s\n'.format(
+                '' if len(durations) == len(config['envlist']) else '>',
+                estimate_runtime(config['envlist'], durations, slots)))
+
+    serial = not (config.get('pipeline') or config.get('hosts'))
+    if args.resume and not serial:
+        raise SystemExit(
+            'Resuming is only supported without pipeline and hosts.')
+    if args.resume and not config.get('resumable'):
+        raise SystemExit('Resuming requires `resumable` in the config.')
+    resumable = serial and config.get('resumable')
+    journal = None
+    if resumable:
+        build = build_fingerprint()
+        if args.resume:
+            journal = load_journal(JOURNAL_FILE, build)
+            if journal is None:
+                logger.info('There is no failed run of this build to '
+                            'resume.\n')
+
+    if hosts:
+        build_images(hosts, logger, cache=config.get('cache'))
+    else:
+        client = init_client()
+        if journal:
+            logger.info(BOLD.format('Resuming from image {}...\n'.format(
+                journal.image)))
+            image = journal.image
+        else:
+            if resumable:
+                # A new run can't resume the images of a previous one.
+                remove_resume_images(client, logger)
+                journal = Journal(JOURNAL_FILE, build=build)
+            image = build_image(client, logger, cache=config.get('cache'))
+    records = []
     try:
-        for env in config['envlist']:
-            run_env(client, container, config[env], logger)
+        if hosts:
+            run_distributed(hosts, config, logger, records=records)
+        elif config.get('pipeline'):
+            run_pipeline(client, image, config, logger, records=records)
+        else:
+            run_serial(
+                client, image, config, logger, records=records,
+                journal=journal)
     finally:
-        stop_container(client, container, logger)
+        if history:
+            save_history(history, records)
+        if config.get('resources'):
+            resources = config['resources']
+            if not isinstance(resources, dict):
+                resources = {}
+            report_resources(records, resources, logger)
 
 
 if __name__ == '__main__':
@@ -1,13 +1,21 @@
 """Unit tests for moby."""
 
+import argparse
+import concurrent.futures
 import functools
 import io
 import json
 import logging
+import logging.handlers
+import os
+import queue
+import sys
 import tarfile
+import threading
 from unittest import mock
 
 import docker
+import docker.errors
 import pytest
 
 import moby
@@ -27,6 +35,24 @@ def build_image(
     patch.stop()
 
 
+@pytest.fixture
+def begin_env():
+    """begin_env function mock."""
+    patch = mock.patch('moby.begin_env')
+    yield patch.start()
+    patch.stop()
+
+
+@pytest.fixture
+def cache():
+    """A cache entry of the config."""
+    return {
+        'registry': 'localhost:5000',
+        'images': ['spam:latest', 'eggs'],
+        'push': True,
+    }
+
+
 @pytest.fixture
 def client():
     """A mocked docker client."""
@@ -43,6 +69,14 @@ def config():
     }
 
 
+@pytest.fixture
+def complete_env():
+    """complete_env function mock."""
+    patch = mock.patch('moby.complete_env')
+    yield patch.start()
+    patch.stop()
+
+
 @pytest.fixture
 def container():
     """The container."""
@@ -145,6 +179,23 @@ def exit_code(request):
     return request.param
 
 
+@pytest.fixture
+def exclude_own_files():
+    """exclude_own_files function mock, which returns the config as is."""
+    patch = mock.patch(
+        'moby.exclude_own_files', side_effect=lambda config: config)
+    yield patch.start()
+    patch.stop()
+
+
+@pytest.fixture
+def history(tmpdir):
+    """A history database."""
+    history = moby.open_history(str(tmpdir.join('history.sqlite')))
+    yield history
+    history.close()
+
+
 @pytest.fixture
 def image():
     """image mock."""
@@ -189,17 +240,17 @@ def load_config(
 
 
 @pytest.fixture
-def log_formatter():
-    """log formatter mock."""
-    patch = mock.patch('logging.Formatter')
+def log_handler():
+    """queue handler mock."""
+    patch = mock.patch('logging.handlers.QueueHandler')
     yield patch.start()
     patch.stop()
 
 
 @pytest.fixture
-def log_handler():
-    """log handler mock."""
-    patch = mock.patch('logging.StreamHandler')
+def log_writer():
+    """LogWriter class mock."""
+    patch = mock.patch('moby.LogWriter')
     yield patch.start()
     patch.stop()
 
@@ -218,6 +269,50 @@ def level(request):
     return request.param
 
 
+@pytest.fixture
+def make_archive():
+    """make_archive function mock."""
+    patch = mock.patch('moby.make_archive')
+    yield patch.start()
+    patch.stop()
+
+
+@pytest.fixture
+def parse_args():
+    """parse_args function mock."""
+    patch = mock.patch(
+        'moby.parse_args',
+        return_value=argparse.Namespace(history=False, resume=False))
+    yield patch.start()
+    patch.stop()
+
+
+@pytest.fixture(
+    params=[False, True],
+    ids=['serial', 'pipeline'])
+def pipeline(request,
+             config):
+    """Toggle the pipeline entry of the config."""
+    if request.param:
+        config['pipeline'] = True
+    return request.param
+
+
+@pytest.fixture
+def parsed_stats():
+    """Docker stats as returned by parse_stats."""
+    return [
+        {'time': time, 'cpu': cpu, 'memory': memory, 'memory_limit': 100,
+         'block_io': block_io, 'network': network}
+        for time, cpu, memory, block_io, network in [
+            (1, 10.0, 10, 0, 0),
+            (2, 50.0, 30, 10, 5),
+            (3, 30.0, 50, 30, 10),
+            (4, 0.0, 95, 30, 10),
+        ]
+    ]
+
+
 @pytest.fixture
 def pull():
     """pull function mock."""
@@ -234,6 +329,20 @@ def push():
     patch.stop()
 
 
+@pytest.fixture
+def record():
+    """EnvRecord mock."""
+    return mock.Mock(moby.EnvRecord)
+
+
+@pytest.fixture
+def resource_sampler():
+    """ResourceSampler class mock."""
+    patch = mock.patch('moby.ResourceSampler')
+    yield patch.start()
+    patch.stop()
+
+
 @pytest.fixture
 def run_command():
     """run_command function mock."""
@@ -250,6 +359,48 @@ def run_env():
     patch.stop()
 
 
+@pytest.fixture
+def run_pipeline():
+    """run_pipeline function mock."""
+    patch = mock.patch('moby.run_pipeline')
+    yield patch.start()
+    patch.stop()
+
+
+@pytest.fixture
+def run_serial():
+    """run_serial function mock."""
+    patch = mock.patch('moby.run_serial')
+    yield patch.start()
+    patch.stop()
+
+
+@pytest.fixture
+def serial_executor():
+    """
+    ThreadPoolExecutor class mock.
+
+    The mocked executor runs the submitted calls at once, so the futures are
+    done when they are returned.
+
+    """
+    def submit(fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+        return future
+
+    executor = mock.MagicMock(concurrent.futures.ThreadPoolExecutor)
+    executor.__enter__.return_value = executor
+    executor.submit.side_effect = submit
+    patch = mock.patch(
+        'concurrent.futures.ThreadPoolExecutor', return_value=executor)
+    yield patch.start()
+    patch.stop()
+
+
 @pytest.fixture(
     params=[True, False],
     ids=['silent', 'not_silent'])
@@ -275,6 +426,27 @@ def stop_container():
     patch.stop()
 
 
+def test_archive_fingerprint(
+        tmpdir):
+    """
+    Test fingerprinting an archive.
+
+    Changing a file should change the fingerprint, changing the modification
+    time of a directory should not.
+
+    """
+    tree = tmpdir.mkdir('tree')
+    tree.join('spam').write('eggs')
+    with tmpdir.as_cwd():
+        first = moby.archive_fingerprint(moby.make_archive(['tree']))
+        tree.setmtime(tree.mtime() - 10)
+        second = moby.archive_fingerprint(moby.make_archive(['tree']))
+        tree.join('spam').write('ham')
+        third = moby.archive_fingerprint(moby.make_archive(['tree']))
+    assert first == second
+    assert second != third
+
+
 def test_build_image(
         client,
         logger):
@@ -304,6 +476,305 @@ def test_build_image(
     ])
 
 
+def test_build_image_aux(
+        client,
+        logger):
+    """
+    Test building an image that reports its id in an aux message.
+
+    The id of the aux message should be returned. The stream messages of a
+    single chunk should be logged at once.
+
+    """
+    output = [
+        b'{"stream": "Step 1/1"}\r\n{"stream": " : FROM spam\\n"}\r\n',
+        b'{"aux": {"ID": "sha256:1234"}}\r\n',
+        b'{"stream": "Successfully built 1234\\n"}\r\n',
+    ]
+    client.build.return_value = iter(output)
+    result = moby.build_image(client, logger)
+    assert result == 'sha256:1234'
+    logger.debug.assert_has_calls([
+        mock.call('Step 1/1 : FROM spam\n'),
+        mock.call('Successfully built 1234\n'),
+    ])
+
+
+def test_build_image_error(
+        client,
+        logger):
+    """
+    Test a failing build.
+
+    A SystemExit should be raised with the error message of the daemon.
+
+    """
+    output = [
+        json.dumps({'stream': 'Step 1/1 : RUN false\n'}).encode(),
+        json.dumps({
+            'errorDetail': {'code': 1, 'message': 'failed'},
+            'error': 'failed',
+        }).encode(),
+    ]
+    client.build.return_value = iter(output)
+    with pytest.raises(SystemExit) as excinfo:
+        moby.build_image(client, logger)
+    assert excinfo.value.args == ('failed',)
+
+
+def test_build_image_cache(
+        cache,
+        client,
+        logger):
+    """
+    Test building an image using a layer cache.
+
+    The pulled cache images should be passed to the build. The cache should
+    be pushed after the build.
+
+    """
+    client.build.return_value = iter([b'{"aux": {"ID": "1234"}}'])
+    with mock.patch('moby.pull_cache') as pull_cache, \
+            mock.patch('moby.push_cache') as push_cache:
+        result = moby.build_image(client, logger, cache=cache)
+    assert result == '1234'
+    pull_cache.assert_called_once_with(client, cache, logger)
+    client.build.assert_called_once_with(
+        path='.',
+        cache_from=pull_cache.return_value)
+    push_cache.assert_called_once_with(client, '1234', cache, logger)
+
+
+def test_build_fingerprint(
+        tmpdir):
+    """Test fingerprinting the build by its Dockerfile."""
+    with tmpdir.as_cwd():
+        empty = moby.build_fingerprint()
+        tmpdir.join('Dockerfile').write('FROM spam')
+        first = moby.build_fingerprint()
+        tmpdir.join('Dockerfile').write('FROM eggs')
+        second = moby.build_fingerprint()
+    assert len({empty, first, second}) == 3
+
+
+def test_build_images(
+        cache,
+        logger):
+    """
+    Test building the image on every host.
+
+    Only the first host should push the cache.
+
+    """
+    hosts = [
+        moby.Host(
+            mock.Mock(docker.APIClient, base_url='http+docker://localhost'),
+            1, url=url)
+        for url in ['unix:///first.sock', 'unix:///second.sock']
+    ]
+    with mock.patch('moby.build_image', side_effect=['first', 'second']) \
+            as build_image:
+        moby.build_images(hosts, logger, cache=cache)
+    assert [host.image for host in hosts] == ['first', 'second']
+    build_image.assert_has_calls([
+        mock.call(hosts[0].client, mock.ANY, cache=cache),
+        mock.call(hosts[1].client, mock.ANY, cache=dict(cache, push=False)),
+    ], any_order=True)
+    loggers = sorted(
+        (call[0][1].extra['stream'], call[0][1].extra['kind'])
+        for call in build_image.call_args_list)
+    assert loggers == [
+        ('unix:///first.sock', 'host'), ('unix:///second.sock', 'host')]
+
+
+def test_cache_images(
+        cache):
+    """Test prefixing the cache images with the registry."""
+    assert moby.cache_images(cache) == [
+        'localhost:5000/spam:latest',
+        'localhost:5000/eggs',
+    ]
+    del cache['registry']
+    assert moby.cache_images(cache) == ['spam:latest', 'eggs']
+
+
+def test_check_stream(
+        logger):
+    """
+    Test checking the output of a pull or push.
+
+    Status messages should be logged, errors should be raised.
+
+    """
+    moby.check_stream([b'{"status": "Pulling"}'], logger)
+    logger.debug.assert_called_once_with('Pulling\n')
+    with pytest.raises(docker.errors.DockerException):
+        moby.check_stream([b'{"error": "denied"}'], logger)
+
+
+def test_commit_container(
+        client,
+        container,
+        logger,
+        tmpdir):
+    """Test committing a failed container to resume from."""
+    client.commit.return_value = {'Id': 'committed'}
+    journal = moby.Journal(str(tmpdir.join('journal.json')), build='build')
+    with tmpdir.as_cwd():
+        moby.commit_container(client, container, journal, logger)
+    client.commit.assert_called_once_with(
+        container, repository=moby.RESUME_REPOSITORY,
+        conf={'Labels': {moby.RESUME_LABEL: str(tmpdir)}})
+    assert journal.image == 'committed'
+    assert json.loads(tmpdir.join('journal.json').read())['image'] == (
+        'committed')
+
+
+def test_complete_env(
+        client,
+        container,
+        logger,
+        stop_container):
+    """
+    Test completing an environment.
+
+    The environment should be finished and the container should be stopped,
+    also when finishing fails. The failure should be recorded.
+
+    """
+    env = {'run': ['spam']}
+    record = moby.EnvRecord('env')
+    error = docker.errors.DockerException('gone')
+    with mock.patch('moby.finish_env', side_effect=error) as finish:
+        with pytest.raises(docker.errors.DockerException):
+            moby.complete_env(client, container, env, logger, record=record)
+    finish.assert_called_once_with(
+        client, container, env, logger, record=record)
+    stop_container.assert_called_once_with(client, container, logger)
+    assert record.finished is not None
+    assert record.exit_code == 1
+
+
+@pytest.mark.parametrize(
+    'chunks',
+    [
+        [b'{"a": 1}{"b": 2}'],
+        [b'{"a": 1}\r\n{"b', b'": 2}\r\n'],
+        [b'{"a"', b': 1}', b'', b'  {"b": 2}'],
+    ],
+    ids=['multiple', 'partial', 'split'])
+def test_decode_stream(
+        chunks):
+    """
+    Test decoding a stream of JSON messages.
+
+    Messages should be decoded regardless of the chunk boundaries.
+
+    """
+    messages = [
+        message
+        for batch in moby.decode_stream(chunks)
+        for message in batch
+    ]
+    assert messages == [{'a': 1}, {'b': 2}]
+
+
+def test_decode_stream_unicode():
+    """Test decoding a multi-byte character split across chunks."""
+    data = json.dumps({'stream': '\u20ac'}, ensure_ascii=False).encode()
+    chunks = [data[:13], data[13:]]
+    assert list(moby.decode_stream(chunks)) == [[{'stream': '\u20ac'}]]
+
+
+def test_decode_stream_incomplete():
+    """Test a stream that ends with an incomplete message."""
+    with pytest.raises(ValueError):
+        list(moby.decode_stream([b'{"a": 1}', b'{"b"']))
+
+
+@pytest.mark.parametrize(
+    'response',
+    [io.BytesIO(b'archive'), iter([b'arch', b'ive'])],
+    ids=['file', 'chunks'])
+def test_fetch_archive(
+        client,
+        container,
+        response):
+    """Test fetching the archive of a path in the container."""
+    client.get_archive.return_value = (response, {})
+    result = moby.fetch_archive(client, container, '/spam')
+    assert result.getvalue() == b'archive'
+    client.get_archive.assert_called_once_with(container, '/spam')
+
+
+def test_env_record():
+    """
+    Test recording an environment.
+
+    Commands should be recorded, a failing command sets the exit code.
+    Failing should keep the exit code of a failed command. Finishing should be
+    idempotent.
+
+    """
+    record = moby.EnvRecord('spam')
+    record.add_command('true', record.started, 0)
+    record.add_command('false', record.started, 2)
+    assert [command['command'] for command in record.commands] == [
+        'true', 'false']
+    assert record.exit_code == 2
+    record.fail()
+    assert record.exit_code == 2
+    failed = moby.EnvRecord('eggs')
+    failed.fail()
+    assert failed.exit_code == 1
+    record.finish()
+    finished = record.finished
+    record.finish()
+    assert record.finished == finished
+    assert record.duration == finished - record.started
+
+
+def test_estimate_runtime():
+    """
+    Test estimating the runtime.
+
+    Environments should be scheduled on the slot that frees up first,
+    environments without estimate are left out.
+
+    """
+    durations = {'long': 4.0, 'short': 1.0, 'medium': 2.0}
+    names = ['long', 'new', 'medium', 'short']
+    assert moby.estimate_runtime(names, durations) == 7.0
+    assert moby.estimate_runtime(names, durations, slots=2) == 4.0
+    assert moby.estimate_runtime(names, {}, slots=2) == 0.0
+    assert moby.estimate_runtime(['medium', 'short', 'long'], durations,
+                                 slots=2) == 5.0
+
+
+def test_fingerprint():
+    """Test fingerprinting data."""
+    assert moby.fingerprint('a', b'b') == moby.fingerprint('a', b'b')
+    assert moby.fingerprint('a', b'b') != moby.fingerprint('a', 'b')
+    assert moby.fingerprint('ab') != moby.fingerprint('a', 'b')
+    assert moby.fingerprint({'a': 1, 'b': 2}) == moby.fingerprint(
+        {'b': 2, 'a': 1})
+
+
+@pytest.mark.parametrize(
+    'durations, expected',
+    [
+        ([1.0], '1.0s'),
+        ([1.0, 1.0], '1.0s (average 1.0s, +0%)'),
+        ([3.0, 1.0, 3.0], '3.0s (average 2.0s, +50%) REGRESSION'),
+    ],
+    ids=['single', 'steady', 'regression'])
+def test_format_trend(
+        durations,
+        expected):
+    """Test formatting the trend of durations."""
+    assert moby.format_trend(durations) == expected
+
+
 def test_init_client():
     """Test initialising a docker client."""
     with mock.patch('docker.APIClient') as apiclient:
@@ -313,40 +784,253 @@ def test_init_client():
     apiclient.assert_called_once_with()
 
 
+def test_init_client_base_url():
+    """Test initialising a docker client for a given daemon."""
+    with mock.patch('docker.APIClient') as apiclient:
+        result = moby.init_client('unix:///spam.sock')
+
+    assert result == apiclient.return_value
+    apiclient.assert_called_once_with(base_url='unix:///spam.sock')
+
+
+def test_init_hosts(
+        client):
+    """
+    Test initialising the docker hosts.
+
+    The capacity should default to the number of CPUs of the host.
+
+    """
+    client.info.return_value = {'NCPU': 8}
+    with mock.patch('moby.init_client', return_value=client) as init_client:
+        hosts = moby.init_hosts([
+            'unix:///first.sock',
+            {'url': 'unix:///second.sock', 'capacity': 2},
+        ])
+    init_client.assert_has_calls([
+        mock.call('unix:///first.sock'),
+        mock.call('unix:///second.sock'),
+    ])
+    assert [host.client for host in hosts] == [client, client]
+    assert [host.capacity for host in hosts] == [8, 2]
+    assert [host.url for host in hosts] == [
+        'unix:///first.sock', 'unix:///second.sock']
+    assert all(host.free == host.capacity for host in hosts)
+
+
 def test_init_logger(
-        log_formatter,
         level,
         log_handler,
+        log_writer,
         logger):
     """
     Test initialising the logger.
 
-    The logger should be initialised on the info level. The default terminator
-    should be removed.
+    The logger should be initialised on the info level. The records should be
+    queued and written by a log writer, which is stopped at exit.
 
     """
-    with mock.patch('logging.getLogger', return_value=logger) as getlogger:
+    with mock.patch('logging.getLogger', return_value=logger) as getlogger, \
+            mock.patch('atexit.register') as register:
         if level:
-            result = moby.init_logger(level=level)
+            result = moby.init_logger(level=level, log_dir='logs')
         else:
             result = moby.init_logger()
+    log_dir = 'logs' if level else None
     level = level or logging.INFO
     assert result == logger
     getlogger.assert_called_once_with(moby.__name__)
     logger.setLevel.assert_called_once_with(level)
 
-    log_handler.assert_called_once_with()
+    log_writer.assert_called_once_with(
+        mock.ANY, sys.stderr, level=level, log_dir=log_dir)
+    records = log_writer.call_args[0][0]
+    log_writer = log_writer.return_value
+    log_writer.start.assert_called_once_with()
+    register.assert_called_once_with(log_writer.stop)
+
+    log_handler.assert_called_once_with(records)
     log_handler = log_handler.return_value
     log_handler.setLevel.assert_called_once_with(level)
-    assert log_handler.terminator == ''
-
-    log_formatter.assert_called_once_with('%(message)s')
-    log_formatter = log_formatter.return_value
-    log_handler.setFormatter.assert_called_once_with(log_formatter)
 
     logger.addHandler.assert_called_once_with(log_handler)
 
 
+def test_journal(
+        tmpdir):
+    """
+    Test journaling steps.
+
+    The completed steps should be skipped in order, the steps after them
+    should run. Completed steps should be saved.
+
+    """
+    path = str(tmpdir.join('journal.json'))
+    journal = moby.Journal(
+        path, build='build', image='image', completed=['a', 'b'])
+    assert journal.skip('a')
+    assert journal.skip('b')
+    assert not journal.skip('c')
+    assert not journal.resuming
+    journal.complete('c')
+    assert not journal.skip('d')
+    assert json.loads(tmpdir.join('journal.json').read()) == {
+        'build': 'build',
+        'image': 'image',
+        'steps': ['a', 'b', 'c'],
+    }
+    journal.remove()
+    assert not tmpdir.join('journal.json').exists()
+    journal.remove()
+
+
+def test_journal_changed(
+        tmpdir):
+    """
+    Test resuming when a completed step changed.
+
+    The image already holds the effects of the later completed steps, so
+    resuming should be refused.
+
+    """
+    path = tmpdir.join('journal.json')
+    journal = moby.Journal(
+        str(path), build='build', image='image', completed=['a', 'b', 'c'])
+    assert journal.skip('a')
+    with pytest.raises(moby.ResumeError):
+        journal.skip('changed')
+    assert not path.exists()
+
+
+def test_load_journal(
+        tmpdir):
+    """
+    Test loading the journal of a failed run.
+
+    Only a journal of the same build with a committed image can be resumed.
+
+    """
+    path = tmpdir.join('journal.json')
+    assert moby.load_journal(str(path), 'build') is None
+    path.write(json.dumps({'build': 'build', 'image': None, 'steps': []}))
+    assert moby.load_journal(str(path), 'build') is None
+    path.write(json.dumps(
+        {'build': 'build', 'image': 'image', 'steps': ['a']}))
+    assert moby.load_journal(str(path), 'other') is None
+    journal = moby.load_journal(str(path), 'build')
+    assert journal.image == 'image'
+    assert journal.completed == ['a']
+    assert journal.resuming
+
+
+def test_log_writer(
+        tmpdir):
+    """
+    Test writing log records.
+
+    The messages of a batch should be written to the console at once. Records
+    of streams should be written to log files and prefixed when requested.
+
+    """
+    console = mock.Mock(io.StringIO)
+    records = queue.Queue()
+    writer = moby.LogWriter(records, console, log_dir=str(tmpdir))
+    logger = logging.getLogger('test_log_writer')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    try:
+        logger.debug('hidden\n')
+        first = moby.StreamLogger(logger, 'first', prefix=True)
+        second = moby.StreamLogger(logger, 'second', prefix=True)
+        host = moby.StreamLogger(logger, 'unix:///host.sock', kind='host')
+        first.info('spam ', extra={'command': 'echo spam'})
+        second.info('eggs\n')
+        first.info('ham\n')
+        host.debug('build\n')
+    finally:
+        logger.handlers = []
+    writer.write([records.get_nowait() for _ in range(records.qsize())])
+    console.write.assert_called_with(
+        '[first] spam \n[second] eggs\n[first] ham\n')
+    assert console.write.call_count == 1
+    assert tmpdir.join('moby.log').read() == (
+        'hidden\nspam eggs\nham\nbuild\n')
+    assert tmpdir.join('{}.log'.format(
+        moby.log_name('host', 'unix:///host.sock'))).read() == 'build\n'
+    assert tmpdir.join('env-first.log').read() == 'spam ham\n'
+    assert tmpdir.join('env-second.log').read() == 'eggs\n'
+    assert tmpdir.join('env-first.{}.log'.format(
+        moby.log_name('cmd', 'echo spam'))).read() == 'spam '
+
+
+def test_log_writer_error(
+        capsys,
+        tmpdir):
+    """
+    Test failing to write the log files.
+
+    The error should be reported to stderr and writing the log files should
+    be disabled, while writing to the console continues.
+
+    """
+    log_dir = tmpdir.join('file')
+    log_dir.write('')
+    console = io.StringIO()
+    writer = moby.LogWriter(
+        queue.Queue(), console, interval=0, log_dir=str(log_dir))
+    writer.start()
+    for message in ['spam\n', 'eggs\n']:
+        writer.records.put(logging.makeLogRecord(
+            {'msg': message, 'levelno': logging.INFO}))
+    writer.stop()
+    assert console.getvalue() == 'spam\neggs\n'
+    assert writer.log_dir is None
+    err = capsys.readouterr().err
+    assert err.startswith('--- Logging error ---\n')
+    assert err.endswith('Writing log files is disabled.\n')
+    assert err.count('--- Logging error ---') == 1
+
+
+def test_log_writer_stop():
+    """
+    Test stopping the log writer.
+
+    The queued records should be written before the writer stops.
+
+    """
+    console = io.StringIO()
+    writer = moby.LogWriter(queue.Queue(), console, interval=0)
+    for message in ['spam\n', 'eggs\n']:
+        writer.records.put(logging.makeLogRecord(
+            {'msg': message, 'levelno': logging.INFO}))
+    writer.start()
+    writer.stop()
+    assert console.getvalue() == 'spam\neggs\n'
+    assert not writer.is_alive()
+
+
+def test_log_name():
+    """
+    Test naming log files.
+
+    Safe names should be kept. Names that are changed to make them safe
+    should get a hash, so they don't share a log file.
+
+    """
+    assert moby.log_name('env', 'moby') == 'env-moby'
+    assert moby.log_name('env', 'py3-6_x') == 'env-py3-6_x'
+    name = moby.log_name('cmd', 'echo spam')
+    assert name.startswith('cmd-echo_spam-')
+    assert name != moby.log_name('cmd', 'echo/spam')
+    assert '.' not in moby.log_name('env', 'first.cmd-spam')
+    long_names = [
+        moby.log_name('cmd', 'echo ' + 'x' * 200 + end) for end in 'ab'
+    ]
+    assert long_names[0] != long_names[1]
+    assert all(len(name) < 120 for name in long_names)
+
+
 def test_load_config():
     """
     Test loading the config file.
@@ -365,74 +1049,657 @@ def test_load_config():
     load.assert_called_once_with(_open.return_value)
 
 
-def test_pull(
-        client,
-        container,
-        cwd,
-        logger,
-        run_command):
+def test_make_archive(
+        tmpdir):
     """
-    Test pulling files from a container.
+    Test creating an archive.
 
-    Each file should be downloaded and extracted to the current working dir.
+    The files should be added to a tar archive which is returned as bytes.
+    Directories should be added recursively, except for excluded entries.
+    Explicitly given files should never be excluded. The ignore files should
+    only be used when given.
 
     """
-    files = [
-        'relative',
-        '/abso/lute'
+    tmpdir.join('.dockerignore').write('# comment\n**/*.pyc\nbuild/\n')
+    tmpdir.join('.gitignore').write('/src/generated\n!keep.pyc\n')
+    tmpdir.join('spam').write('eggs')
+    tmpdir.join('ignored.pyc').write('')
+    src = tmpdir.mkdir('src')
+    src.join('module.py').write('ham')
+    src.join('module.pyc').write('')
+    src.join('keep.pyc').write('')
+    src.join('generated').write('')
+    src.mkdir('build').join('output').write('')
+    src.mkdir('node_modules').mkdir('dep').join('index.js').write('')
+    with tmpdir.as_cwd():
+        with mock.patch('moby.SCAN_BATCH', 2), \
+                mock.patch('moby.SCAN_WINDOW', 1), \
+                mock.patch('moby.SCAN_READ_LIMIT', 3):
+            result = moby.make_archive(
+                ['spam', 'ignored.pyc', 'src'], exclude=['node_modules'],
+                ignore_files=['.dockerignore', '.gitignore'])
+            unignored = moby.make_archive(['src'], exclude=['node_modules'])
+    archive = tarfile.open(fileobj=io.BytesIO(result), mode='r')
+    assert archive.getnames() == [
+        'spam',
+        'ignored.pyc',
+        'src',
+        'src/build',
+        'src/build/output',
+        'src/keep.pyc',
+        'src/module.py',
+    ]
+    assert archive.extractfile('spam').read() == b'eggs'
+    assert archive.extractfile('src/module.py').read() == b'ham'
+    unignored = tarfile.open(fileobj=io.BytesIO(unignored), mode='r')
+    assert unignored.getnames() == [
+        'src',
+        'src/build',
+        'src/build/output',
+        'src/generated',
+        'src/keep.pyc',
+        'src/module.py',
+        'src/module.pyc',
     ]
 
-    tar_stream = io.BytesIO()
-    tar = tarfile.open(fileobj=tar_stream, mode='w')
-    for f in files:
-        tarinfo = tarfile.TarInfo(name=f)
-        tar.addfile(tarinfo, fileobj=io.BytesIO())
-    tar_stream.seek(0)
-    client.get_archive.return_value = (tar_stream, {})
-
-    tar_mocks = [mock.Mock(tarfile.TarFile) for f in files]
-    with mock.patch('tarfile.open', side_effect=tar_mocks):
-        moby.pull(client, container, files, logger)
 
-    run_command.assert_called_once_with(
-        client, container, 'pwd', logger, silent=True)
-    client.get_archive.assert_has_calls([
-        mock.call(container, '/'.join([cwd, 'relative'])),
-        mock.call(container, '/abso/lute')
-    ])
-    for tar_mock in tar_mocks:
-        tar_mock.extractall.assert_called_once_with()
+def test_make_archive_headers(
+        tmpdir):
+    """
+    Test the headers of an archive.
 
+    The headers should be the ones `tarfile` creates, including symbolic and
+    hard links.
 
-def test_push(
-        client,
-        container,
-        cwd,
-        logger,
-        run_command):
     """
-    Test pushing files to a container.
+    tree = tmpdir.mkdir('tree')
+    tree.join('file').write('spam')
+    tree.join('link').mksymlinkto('file')
+    os.link(str(tree.join('file')), str(tree.join('hard')))
+    os.mkfifo(str(tree.join('fifo')))
+    tree.mkdir('dir')
+    with tmpdir.as_cwd():
+        result = moby.make_archive(['tree'])
+        expected = tarfile.open(fileobj=io.BytesIO(), mode='w')
+        headers = [
+            dict(expected.gettarinfo(name).get_info(), chksum=None)
+            for name in tarfile.open(
+                fileobj=io.BytesIO(result), mode='r').getnames()
+        ]
+    archive = tarfile.open(fileobj=io.BytesIO(result), mode='r')
+    assert [
+        dict(member.get_info(), chksum=None) for member in archive
+    ] == headers
+    assert [member.name for member in archive if member.islnk()] == [
+        'tree/hard']
+
+
+def test_exclude_own_files(
+        tmpdir):
+    """
+    Test excluding the files moby writes from the `push` entries.
 
-    Files should be put in a tarfile and pushed to the container using the
-    client.
+    The files should be excluded from every environment and its `before` and
+    `after` entries, except for files outside the current directory.
+
+    """
+    config = {
+        'envlist': ['first', 'second'],
+        'history': 'state/history[1].sqlite',
+        'log_dir': str(tmpdir.dirpath('logs')),
+        'resources': {'output': 'resources.json'},
+        'first': {'push': ['.'], 'exclude': ['spam']},
+        'second': {'before': {'push': ['.']}, 'after': {'run': ['eggs']}},
+    }
+    with tmpdir.as_cwd():
+        result = moby.exclude_own_files(config)
+    own = ['/state/history[[]1].sqlite', '/.moby-journal.json',
+           '/resources.json']
+    assert result['first']['exclude'] == ['spam'] + own
+    assert result['second']['exclude'] == own
+    assert result['second']['before']['exclude'] == own
+    assert result['second']['after']['exclude'] == own
+    assert 'exclude' not in config['first']['exclude']
+    patterns = moby.load_excludes(own)
+    assert moby.excluded('state/history[1].sqlite', False, patterns)
+    assert not moby.excluded('state/history1.sqlite', False, patterns)
+
+
+@pytest.mark.parametrize(
+    'path, is_dir, expected',
+    [
+        ('spam.pyc', False, True),
+        ('a/b/spam.pyc', False, True),
+        ('a/keep.pyc', False, False),
+        ('build', True, True),
+        ('build', False, False),
+        ('src/build', True, True),
+        ('docs', True, True),
+        ('src/docs', True, False),
+        ('src/spam.txt', False, True),
+        ('src/a/spam.txt', False, False),
+        ('lib/a/b/spam.so', False, True),
+    ],
+    ids=[
+        'name', 'nested_name', 'negated', 'dir', 'dir_only', 'nested_dir',
+        'anchored', 'anchored_nested', 'wildcard', 'wildcard_slash',
+        'double_wildcard'])
+def test_excluded(
+        path,
+        is_dir,
+        expected):
+    """Test matching paths against exclude patterns."""
+    patterns = moby.load_excludes(
+        ['*.pyc', '!keep.pyc', 'build/', '/docs', 'src/*.txt', 'lib/**/*.so'])
+    assert moby.excluded(path, is_dir, patterns) == expected
+
+
+def test_load_excludes(
+        tmpdir):
+    """
+    Test loading the exclude patterns of ignore files.
+
+    The patterns of a `.dockerignore` file should match the path relative to
+    the current directory, like docker does.
+
+    """
+    tmpdir.join('.dockerignore').write('build\n*.pyc\n')
+    tmpdir.join('.gitignore').write('dist\n')
+    with tmpdir.as_cwd():
+        patterns = moby.load_excludes(
+            ignore_files=['.dockerignore', '.gitignore', 'missing'])
+    assert moby.excluded('build', True, patterns)
+    assert not moby.excluded('src/build', True, patterns)
+    assert moby.excluded('spam.pyc', False, patterns)
+    assert not moby.excluded('src/spam.pyc', False, patterns)
+    assert moby.excluded('src/dist', True, patterns)
+    assert moby.load_excludes() == []
+
+
+def test_prepare_env(
+        client,
+        image,
+        logger,
+        make_archive,
+        start_container):
+    """
+    Test preparing an environment.
+
+    A container should be started and the archive of the `push` entry should
+    be created using the executor.
+
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    with executor:
+        container, archive = moby.prepare_env(
+            executor, client, image,
+            {'push': ['spam'], 'exclude': ['eggs'],
+             'ignore_files': ['.gitignore']}, logger)
+        assert container.result() == start_container.return_value
+        assert archive.result() == make_archive.return_value
+        container, archive = moby.prepare_env(
+            executor, client, image, {'run': ['spam']}, logger)
+        assert archive is None
+    start_container.assert_called_with(client, image, logger)
+    make_archive.assert_called_once_with(
+        ['spam'], exclude=['eggs'], ignore_files=['.gitignore'])
+
+
+def test_measure_resources(
+        parsed_stats):
+    """
+    Test measuring the resource usage of an environment.
+
+    The usage should be summarised for the environment and each command.
+
+    """
+    record = moby.EnvRecord('env')
+    record.started, record.finished = 1, 4
+    record.commands.append({'command': 'spam', 'started': 1.5, 'finished': 3})
+    record.commands.append(
+        {'command': 'eggs', 'started': 3.2, 'finished': 3.5})
+    moby.measure_resources(record, parsed_stats)
+    assert record.resources['samples'] == 4
+    assert record.commands[0]['resources']['samples'] == 2
+    assert record.commands[1]['resources'] is None
+
+
+def test_order_envs():
+    """
+    Test ordering environments longest first.
+
+    Environments without estimate go first.
+
+    """
+    durations = {'short': 1.0, 'long': 10.0}
+    result = moby.order_envs(['short', 'new', 'long'], durations)
+    assert result == ['new', 'long', 'short']
+
+
+def test_parse_stats():
+    """
+    Test parsing a sample of the docker stats API.
+
+    The CPU usage should be relative to a single CPU. The page cache should
+    not count as memory usage.
+
+    """
+    stats = {
+        'cpu_stats': {
+            'cpu_usage': {'total_usage': 300},
+            'system_cpu_usage': 2000,
+            'online_cpus': 4,
+        },
+        'precpu_stats': {
+            'cpu_usage': {'total_usage': 100},
+            'system_cpu_usage': 1000,
+        },
+        'memory_stats': {
+            'usage': 500,
+            'limit': 1000,
+            'stats': {'inactive_file': 100},
+        },
+        'blkio_stats': {
+            'io_service_bytes_recursive': [
+                {'op': 'Read', 'value': 10},
+                {'op': 'Write', 'value': 20},
+                {'op': 'Total', 'value': 30},
+            ],
+        },
+        'networks': {
+            'eth0': {'rx_bytes': 1, 'tx_bytes': 2},
+            'eth1': {'rx_bytes': 3, 'tx_bytes': 4},
+        },
+    }
+    assert moby.parse_stats(stats) == {
+        'cpu': 80.0,
+        'memory': 400,
+        'memory_limit': 1000,
+        'block_io': 30,
+        'network': 10,
+    }
+
+
+def test_parse_stats_first():
+    """Test parsing the first sample, which has no previous CPU stats."""
+    result = moby.parse_stats({
+        'cpu_stats': {'cpu_usage': {'total_usage': 100}},
+        'precpu_stats': {},
+    })
+    assert result['cpu'] == 0.0
+    assert result['memory'] == 0
+
+
+def test_parse_args():
+    """Test parsing the command line arguments."""
+    args = moby.parse_args([])
+    assert not args.history
+    assert not args.resume
+    assert moby.parse_args(['--history']).history
+    assert moby.parse_args(['--resume']).resume
+
+
+def test_pull(
+        client,
+        container,
+        cwd,
+        logger,
+        run_command):
+    """
+    Test pulling files from a container.
+
+    Each file should be downloaded and extracted to the current working dir.
+
+    """
+    files = [
+        'relative',
+        '/abso/lute'
+    ]
+
+    tar_stream = io.BytesIO()
+    tar = tarfile.open(fileobj=tar_stream, mode='w')
+    for f in files:
+        tarinfo = tarfile.TarInfo(name=f)
+        tar.addfile(tarinfo, fileobj=io.BytesIO())
+    tar_stream.seek(0)
+    client.get_archive.return_value = (tar_stream, {})
+
+    tar_mocks = [mock.Mock(tarfile.TarFile) for f in files]
+    with mock.patch('tarfile.open', side_effect=tar_mocks):
+        moby.pull(client, container, files, logger)
+
+    run_command.assert_called_once_with(
+        client, container, 'pwd', logger, silent=True)
+    client.get_archive.assert_has_calls([
+        mock.call(container, '/'.join([cwd, 'relative'])),
+        mock.call(container, '/abso/lute')
+    ], any_order=True)
+    for tar_mock in tar_mocks:
+        tar_mock.extractall.assert_called_once_with()
+
+
+def test_pull_absolute(
+        client,
+        container,
+        logger,
+        run_command):
+    """
+    Test pulling absolute files from a container.
+
+    The working dir of the container isn't needed, so no command should be
+    run. The archives should be extracted in the order of the files.
+
+    """
+    files = ['/first', '/second']
+    archives = {path: io.BytesIO(path.encode()) for path in files}
+    client.get_archive.side_effect = lambda container, path: (
+        archives[path], {})
+    record = moby.EnvRecord('env')
+    with mock.patch('tarfile.open') as tar_open:
+        moby.pull(client, container, files, logger, record=record)
+    assert not run_command.called
+    assert record.pulled == len('/first') + len('/second')
+    opened = [
+        call[1]['fileobj'].getvalue() for call in tar_open.call_args_list
+    ]
+    assert opened == [b'/first', b'/second']
+
+
+def test_pull_skip(
+        client,
+        container,
+        logger,
+        run_command):
+    """Test skipping a pull that completed in the run that is resumed."""
+    journal = mock.Mock(moby.Journal)
+    journal.skip.return_value = True
+    record = moby.EnvRecord('env', journal=journal)
+    moby.pull(client, container, ['spam'], logger, record=record)
+    journal.skip.assert_called_once_with(
+        moby.fingerprint('env', 'pull', ['spam']))
+    assert not client.get_archive.called
+    assert not run_command.called
+
+
+def test_pull_cache(
+        cache,
+        client,
+        logger):
+    """
+    Test pulling the cache images.
+
+    Images that can't be pulled should be skipped.
+
+    """
+    client.pull.side_effect = [
+        iter([b'{"status": "Downloaded"}']),
+        docker.errors.NotFound('not found'),
+    ]
+    result = moby.pull_cache(client, cache, logger)
+    assert result == ['localhost:5000/spam:latest']
+    client.pull.assert_has_calls([
+        mock.call('localhost:5000/spam', tag='latest', stream=True),
+        mock.call('localhost:5000/eggs', tag=None, stream=True),
+    ])
+    assert logger.warning.called
+
+
+def test_push(
+        client,
+        container,
+        cwd,
+        logger,
+        make_archive,
+        run_command):
+    """
+    Test pushing files to a container.
+
+    Files should be put in a tarfile and pushed to the container using the
+    client.
 
     """
     files = [
         'relative',
         '/abso/lute'
     ]
+    make_archive.return_value = b'archive'
+    record = moby.EnvRecord('env')
 
-    with mock.patch('tarfile.open') as tar_mock:
-        moby.push(client, container, files, logger)
+    moby.push(
+        client, container, files, logger, exclude=['spam'], record=record)
     run_command.assert_called_once_with(
         client, container, 'pwd', logger, silent=True)
-    tar_mock.assert_called_once_with(fileobj=mock.ANY, mode='w')
-    archive_file = tar_mock.call_args[1]['fileobj']
-    tar_mock.return_value.add.assert_has_calls([
-        mock.call(f) for f in files
+    make_archive.assert_called_once_with(
+        files, exclude=['spam'], ignore_files=None)
+    client.put_archive.assert_called_once_with(container, cwd, b'archive')
+    assert record.pushed == len(b'archive')
+
+
+def test_push_skip(
+        client,
+        container,
+        logger,
+        run_command):
+    """Test skipping a push that completed in the run that is resumed."""
+    journal = mock.Mock(moby.Journal)
+    journal.skip.return_value = True
+    record = moby.EnvRecord('env', journal=journal)
+    archive = moby.make_archive([])
+    moby.push(client, container, ['spam'], logger, archive=archive,
+              record=record)
+    journal.skip.assert_called_once_with(moby.fingerprint(
+        'env', 'push', ['spam'], moby.archive_fingerprint(archive)))
+    assert not client.put_archive.called
+    assert not run_command.called
+
+
+def test_push_resume(
+        client,
+        container,
+        logger,
+        run_command,
+        tmpdir):
+    """
+    Test resuming a push of the current directory.
+
+    The files moby writes during the failed run should not change the push,
+    so it should be skipped when resuming.
+
+    """
+    config = moby.exclude_own_files({
+        'envlist': ['env'],
+        'log_dir': 'logs',
+        'env': {'push': ['.'], 'run': ['spam']},
+    })
+    env = config['env']
+    tmpdir.join('spam').write('eggs')
+    with tmpdir.as_cwd():
+        journal = moby.Journal(moby.JOURNAL_FILE)
+        record = moby.EnvRecord('env', journal=journal)
+        moby.push(client, container, env['push'], logger,
+                  exclude=env['exclude'], record=record)
+        tmpdir.join(moby.HISTORY_FILE).write('history')
+        tmpdir.mkdir('logs').join('moby.log').write('log')
+        journal = moby.Journal(moby.JOURNAL_FILE, completed=journal.steps)
+        record = moby.EnvRecord('env', journal=journal)
+        moby.push(client, container, env['push'], logger,
+                  exclude=env['exclude'], record=record)
+    assert client.put_archive.call_count == 1
+    archive = tarfile.open(
+        fileobj=io.BytesIO(client.put_archive.call_args[0][2]), mode='r')
+    assert archive.getnames() == ['.', './spam']
+
+
+def test_push_cache(
+        cache,
+        client,
+        image,
+        logger):
+    """
+    Test pushing the cache images.
+
+    The image should be tagged as the first cache image and all cache images
+    should be pushed. Failing to push should only be logged.
+
+    """
+    client.push.side_effect = [
+        iter([b'{"status": "Pushed"}']),
+        iter([b'{"errorDetail": {"message": "denied"}}']),
+    ]
+    moby.push_cache(client, image, cache, logger)
+    client.tag.assert_called_once_with(
+        image, 'localhost:5000/spam', tag='latest')
+    client.push.assert_has_calls([
+        mock.call('localhost:5000/spam', tag='latest', stream=True),
+        mock.call('localhost:5000/eggs', tag=None, stream=True),
+    ])
+    assert logger.warning.call_count == 1
+
+
+def test_push_cache_tag_failure(
+        cache,
+        client,
+        image,
+        logger):
+    """
+    Test failing to tag the cache image.
+
+    The failure should only be logged, the other cache images should still be
+    pushed.
+
+    """
+    client.tag.side_effect = docker.errors.APIError('no such image')
+    client.push.return_value = iter([b'{"status": "Pushed"}'])
+    moby.push_cache(client, image, cache, logger)
+    client.push.assert_called_once_with(
+        'localhost:5000/eggs', tag=None, stream=True)
+    logger.warning.assert_called_once_with(
+        'Failed to push localhost:5000/spam:latest: no such image\n')
+
+
+def test_remove_resume_images(
+        client,
+        logger,
+        tmpdir):
+    """
+    Test removing the images to resume from.
+
+    Only the images of the current directory should be removed. Images that
+    are gone already should be skipped, other failures should be logged.
+
+    """
+    client.images.return_value = ['child', 'parent', 'used']
+    client.remove_image.side_effect = [
+        None,
+        docker.errors.NotFound('gone'),
+        docker.errors.APIError('in use'),
+    ]
+    with tmpdir.as_cwd():
+        moby.remove_resume_images(client, logger)
+    client.images.assert_called_once_with(
+        all=True, quiet=True,
+        filters={'label': '{}={}'.format(moby.RESUME_LABEL, tmpdir)})
+    client.remove_image.assert_has_calls([
+        mock.call(image, force=True) for image in ['child', 'parent', 'used']
+    ])
+    logger.warning.assert_called_once_with('Failed to remove used: in use\n')
+
+
+def test_report_history(
+        history,
+        logger):
+    """
+    Test reporting the history.
+
+    The trend of every environment and the commands of its latest run should
+    be reported.
+
+    """
+    moby.report_history(history, logger)
+    logger.info.assert_called_once_with('No history recorded yet.\n')
+    logger.reset_mock()
+    for duration in [1.0, 2.0]:
+        record = moby.EnvRecord('spam')
+        record.started, record.finished = 0, duration
+        record.commands.append({
+            'command': 'eggs',
+            'started': 0,
+            'finished': duration,
+            'exit_code': 0})
+        moby.save_history(history, [record])
+    moby.report_history(history, logger)
+    logger.info.assert_has_calls([
+        mock.call(
+            '\033[1mspam\033[0m: 2.0s (average 1.0s, +100%) REGRESSION, '
+            'exit code 0, pushed 0 bytes, pulled 0 bytes\n'),
+        mock.call(
+            "  'eggs': 2.0s (average 1.0s, +100%) REGRESSION\n"),
     ])
-    client.put_archive.assert_called_once_with(
-        container, cwd, archive_file.getvalue())
+
+
+def test_report_resources(
+        logger,
+        parsed_stats,
+        tmpdir):
+    """
+    Test reporting the resource usage.
+
+    Memory bound and idle environments should be warned about. The usage
+    should be written to the output file.
+
+    """
+    busy = moby.EnvRecord('busy')
+    busy.started, busy.finished = 1, 3
+    busy.commands.append({'command': 'spam', 'started': 1, 'finished': 3})
+    moby.measure_resources(busy, parsed_stats)
+    bound = moby.EnvRecord('bound')
+    bound.started, bound.finished = 4, 4
+    moby.measure_resources(bound, parsed_stats)
+    unsampled = moby.EnvRecord('unsampled')
+    output = tmpdir.join('resources.json')
+    moby.report_resources(
+        [busy, bound, unsampled], {'output': str(output)}, logger)
+    logger.warning.assert_has_calls([
+        mock.call('bound used 95% of its memory limit.\n'),
+        mock.call(
+            'bound was mostly idle, its average CPU usage was 0.0%.\n'),
+    ])
+    assert logger.warning.call_count == 2
+    result = json.loads(output.read())
+    assert [env['name'] for env in result] == ['busy', 'bound', 'unsampled']
+    assert result[0]['resources']['cpu_peak'] == 50.0
+    assert result[0]['commands'][0]['resources']['memory_peak'] == 50
+    assert result[2]['resources'] is None
+
+
+def test_resource_sampler(
+        client,
+        container):
+    """
+    Test sampling the resource usage of a container.
+
+    Every sample of the stats API should be parsed and timed.
+
+    """
+    client.stats.return_value = iter([{}, {}])
+    sampler = moby.ResourceSampler(client, container)
+    with mock.patch('moby.parse_stats', side_effect=lambda stats: {}):
+        sampler.start()
+        sampler.stop()
+    client.stats.assert_called_once_with(container, decode=True, stream=True)
+    assert len(sampler.samples) == 2
+    assert all('time' in sample for sample in sampler.samples)
+
+
+def test_resource_sampler_gone(
+        client,
+        container):
+    """Test sampling a container that is gone."""
+    client.stats.side_effect = docker.errors.NotFound('gone')
+    sampler = moby.ResourceSampler(client, container)
+    sampler.start()
+    sampler.stop()
+    assert sampler.samples == []
 
 
 def test_run_command(
@@ -452,13 +1719,15 @@ def test_run_command(
         line for line in [b'first\n', b'second\n'])
     client.exec_inspect.return_value = {'ExitCode': exit_code}
 
+    record = moby.EnvRecord('env')
     run_command = functools.partial(
         moby.run_command,
         client,
         container,
         'command',
         logger,
-        silent=silent)
+        silent=silent,
+        record=record)
     if exit_code:
         with pytest.raises(SystemExit) as excinfo:
             run_command()
@@ -466,6 +1735,8 @@ def test_run_command(
     else:
         result = run_command()
         assert result == 'first\nsecond'
+    assert [command['command'] for command in record.commands] == ['command']
+    assert record.exit_code == exit_code
     client.exec_create.assert_called_once_with(
         container,
         'command')
@@ -475,10 +1746,12 @@ def test_run_command(
     client.exec_inspect.assert_called_once_with(
         client.exec_create.return_value)
     if not silent:
+        extra = {'command': 'command'}
         logger.info.assert_has_calls([
-            mock.call('\033[1mRunning \'command\':\n\033[0m'),
-            mock.call('first\n'),
-            mock.call('second\n')])
+            mock.call(
+                "\033[1mRunning 'command':\n\033[0m", extra=extra),
+            mock.call('first\n', extra=extra),
+            mock.call('second\n', extra=extra)])
 
 
 def test_run_env(
@@ -488,6 +1761,7 @@ def test_run_env(
         logger,
         pull,
         push,
+        record,
         run_command):
     """
     Test running an environment.
@@ -501,28 +1775,519 @@ def test_run_env(
 
     """
     with mock.patch('moby.run_env', wraps=moby.run_env) as run_env:
-        moby.run_env(client, container, env, logger)
+        moby.run_env(client, container, env, logger, record=record)
 
     run_command_calls = [
-        mock.call(client, container, command, logger)
+        mock.call(client, container, command, logger, record=record)
         for command in env['run']
     ]
     run_command.assert_has_calls(run_command_calls)
 
     run_env_calls = [
-        mock.call(client, container, env, logger)
+        mock.call(client, container, env, logger, record=record)
     ]
     if 'before' in env:
-        run_env_calls.append(
-            mock.call(client, container, env['before'], logger))
+        run_env_calls.append(mock.call(
+            client, container, env['before'], logger, record=record))
     if 'after' in env:
-        run_env_calls.append(
-            mock.call(client, container, env['after'], logger))
+        run_env_calls.append(mock.call(
+            client, container, env['after'], logger, record=record))
     run_env.assert_has_calls(run_env_calls)
     if 'push' in env:
-        push.assert_called_once_with(client, container, env['push'], logger)
+        push.assert_called_once_with(
+            client, container, env['push'], logger, archive=None,
+            exclude=None, ignore_files=None, record=record)
     if 'pull' in env:
-        pull.assert_called_once_with(client, container, env['pull'], logger)
+        pull.assert_called_once_with(
+            client, container, env['pull'], logger, record=record)
+
+
+def test_run_command_skip(
+        client,
+        container,
+        logger,
+        tmpdir):
+    """
+    Test skipping a command that completed in the run that is resumed.
+
+    The command should not run, the next command should.
+
+    """
+    completed = moby.fingerprint('env', 'run', 'first')
+    journal = moby.Journal(
+        str(tmpdir.join('journal.json')), completed=[completed])
+    record = moby.EnvRecord('env', journal=journal)
+    assert moby.run_command(
+        client, container, 'first', logger, record=record) == ''
+    assert not client.exec_create.called
+
+    client.exec_start.return_value = iter([b'output'])
+    client.exec_inspect.return_value = {'ExitCode': 0}
+    assert moby.run_command(
+        client, container, 'second', logger, record=record) == 'output'
+    assert journal.steps == [
+        completed, moby.fingerprint('env', 'run', 'second')]
+    assert record.resumed
+    assert not moby.EnvRecord('other', journal=journal).resumed
+
+
+def test_run_distributed(
+        logger):
+    """
+    Test running the environments distributed over hosts.
+
+    Environments should be placed on the host with the most free capacity
+    and all capacity should be used.
+
+    """
+    hosts = [moby.Host(mock.Mock(), 2), moby.Host(mock.Mock(), 1)]
+    config = {'envlist': ['first', 'second', 'third', 'fourth']}
+    for name in config['envlist']:
+        config[name] = {'run': [name]}
+    barrier = threading.Barrier(3, timeout=5)
+
+    def run_on_host(host, env, logger, record, sample):
+        if env['run'] != ['fourth']:
+            barrier.wait()
+
+    records = []
+    with mock.patch('moby.run_on_host', side_effect=run_on_host) as run:
+        moby.run_distributed(hosts, config, logger, records=records)
+    assert [call[0][0] for call in run.call_args_list[:3]] == [
+        hosts[0], hosts[0], hosts[1]]
+    assert [call[0][1] for call in run.call_args_list] == [
+        config[name] for name in config['envlist']]
+    assert [record.name for record in records] == config['envlist']
+    assert all(host.running == 0 for host in hosts)
+
+
+def test_run_distributed_failure(
+        logger):
+    """
+    Test a failing environment when running distributed.
+
+    No environments should be started after the failure, which should be
+    raised.
+
+    """
+    hosts = [moby.Host(mock.Mock(), 1)]
+    config = {'envlist': ['first', 'second']}
+    for name in config['envlist']:
+        config[name] = {'run': [name]}
+    with mock.patch('moby.run_on_host', side_effect=SystemExit(1)) as run:
+        with pytest.raises(SystemExit):
+            moby.run_distributed(hosts, config, logger)
+    assert run.call_count == 1
+    assert hosts[0].running == 0
+
+
+@pytest.mark.parametrize(
+    'sample',
+    [False, True],
+    ids=['no_sample', 'sample'])
+def test_run_on_host(
+        client,
+        container,
+        image,
+        logger,
+        resource_sampler,
+        run_env,
+        sample,
+        start_container,
+        stop_container):
+    """
+    Test running an environment on a host.
+
+    The environment should run in a container of its own, which is stopped
+    afterwards.
+
+    """
+    host = moby.Host(client, 1)
+    host.image = image
+    env = {'run': ['spam']}
+    record = moby.EnvRecord('env')
+    with mock.patch('moby.measure_resources') as measure_resources:
+        moby.run_on_host(host, env, logger, record, sample=sample)
+    start_container.assert_called_once_with(client, image, logger)
+    run_env.assert_called_once_with(
+        client, container, env, logger, record=record)
+    stop_container.assert_called_once_with(client, container, logger)
+    assert record.finished is not None
+    if sample:
+        measure_resources.assert_called_once_with(
+            record, resource_sampler.return_value.samples)
+    else:
+        assert not resource_sampler.called
+
+
+def test_run_on_host_failure(
+        client,
+        container,
+        image,
+        logger,
+        run_env,
+        start_container,
+        stop_container):
+    """
+    Test an environment failing on a host.
+
+    The container should be stopped and the failure should be recorded.
+
+    """
+    host = moby.Host(client, 1)
+    host.image = image
+    record = moby.EnvRecord('env')
+    run_env.side_effect = docker.errors.DockerException('gone')
+    with pytest.raises(docker.errors.DockerException):
+        moby.run_on_host(host, {'run': ['spam']}, logger, record)
+    stop_container.assert_called_once_with(client, container, logger)
+    assert record.finished is not None
+    assert record.exit_code == 1
+
+
+def test_run_pipeline(
+        begin_env,
+        client,
+        complete_env,
+        image,
+        logger,
+        make_archive,
+        start_container,
+        stop_container):
+    """
+    Test running the environments in a pipeline.
+
+    Every environment should run in a container of its own. The prepared
+    archive should be passed on and every environment should be completed.
+
+    """
+    config = {
+        'envlist': ['first', 'second'],
+        'first': {'push': ['spam'], 'run': ['spam']},
+        'second': {'run': ['eggs']},
+    }
+    containers = ['first_container', 'second_container']
+    start_container.side_effect = containers
+    records = []
+    moby.run_pipeline(client, image, config, logger, records=records)
+    assert [record.name for record in records] == config['envlist']
+    assert start_container.call_count == 2
+    begin_env.assert_has_calls([
+        mock.call(
+            client, containers[0], config['first'], mock.ANY,
+            archive=make_archive.return_value, record=records[0]),
+        mock.call(
+            client, containers[1], config['second'], mock.ANY, archive=None,
+            record=records[1]),
+    ])
+    complete_env.assert_has_calls([
+        mock.call(
+            client, containers[0], config['first'], mock.ANY,
+            record=records[0]),
+        mock.call(
+            client, containers[1], config['second'], mock.ANY,
+            record=records[1]),
+    ], any_order=True)
+    assert not stop_container.called
+    for call in begin_env.call_args_list + complete_env.call_args_list:
+        env_logger = call[0][3]
+        assert env_logger.logger == logger
+        assert env_logger.extra['prefix']
+    assert [
+        call[0][3].extra['stream'] for call in begin_env.call_args_list
+    ] == config['envlist']
+
+
+def test_run_pipeline_failure(
+        begin_env,
+        client,
+        complete_env,
+        image,
+        logger,
+        make_archive,
+        start_container,
+        stop_container):
+    """
+    Test a failing environment in a pipeline.
+
+    The failure should be raised and the containers that are not completed
+    should be stopped.
+
+    """
+    config = {
+        'envlist': ['first', 'second', 'third'],
+        'first': {'run': ['spam']},
+        'second': {'run': ['eggs']},
+        'third': {'run': ['ham']},
+    }
+    containers = ['first', 'second', 'third']
+    start_container.side_effect = containers
+    begin_env.side_effect = [None, docker.errors.DockerException('gone')]
+    records = []
+    with pytest.raises(docker.errors.DockerException):
+        moby.run_pipeline(client, image, config, logger, records=records)
+    assert [record.exit_code for record in records] == [0, 1]
+    complete_env.assert_called_once_with(
+        client, containers[0], config['first'], mock.ANY, record=mock.ANY)
+    stop_container.assert_has_calls([
+        mock.call(client, containers[1], mock.ANY),
+        mock.call(client, containers[2], mock.ANY),
+    ])
+    assert stop_container.call_count == 2
+
+
+def test_run_pipeline_complete_failure(
+        begin_env,
+        client,
+        complete_env,
+        image,
+        logger,
+        serial_executor,
+        start_container,
+        stop_container):
+    """
+    Test an environment failing to complete in a pipeline.
+
+    No environments should be begun after the failure, which should be
+    raised. The prepared containers should be stopped.
+
+    """
+    config = {
+        'envlist': ['first', 'second', 'third'],
+        'first': {'run': ['spam']},
+        'second': {'run': ['eggs']},
+        'third': {'run': ['ham']},
+    }
+    containers = ['first', 'second', 'third']
+    start_container.side_effect = containers
+    complete_env.side_effect = SystemExit(1)
+    with pytest.raises(SystemExit):
+        moby.run_pipeline(client, image, config, logger)
+    begin_env.assert_called_once_with(
+        client, containers[0], config['first'], mock.ANY, archive=None,
+        record=mock.ANY)
+    stop_container.assert_has_calls([
+        mock.call(client, containers[1], mock.ANY),
+        mock.call(client, containers[2], mock.ANY),
+    ])
+    assert stop_container.call_count == 2
+
+
+def test_run_serial(
+        client,
+        config,
+        container,
+        image,
+        logger,
+        run_env,
+        start_container,
+        stop_container):
+    """
+    Test running the environments one after another.
+
+    The environments should run in a single container, which is stopped
+    afterwards. Every environment should be recorded.
+
+    """
+    records = []
+    moby.run_serial(client, image, config, logger, records=records)
+    start_container.assert_called_once_with(client, image, logger)
+    run_env.assert_has_calls([
+        mock.call(
+            client, container, config[env], mock.ANY, record=records[index])
+        for index, env in enumerate(config['envlist'])
+    ])
+    streams = [call[0][3].extra['stream'] for call in run_env.call_args_list]
+    assert streams == config['envlist']
+    assert [record.name for record in records] == config['envlist']
+    assert all(record.finished for record in records)
+    stop_container.assert_called_once_with(client, container, logger)
+
+
+def test_run_serial_failure(
+        client,
+        config,
+        container,
+        image,
+        logger,
+        run_env,
+        start_container,
+        stop_container):
+    """
+    Test an environment failing when running serially.
+
+    The container should be stopped and the failure should be recorded.
+
+    """
+    run_env.side_effect = docker.errors.DockerException('gone')
+    records = []
+    with pytest.raises(docker.errors.DockerException):
+        moby.run_serial(client, image, config, logger, records=records)
+    assert [record.name for record in records] == ['first']
+    assert records[0].exit_code == 1
+    assert records[0].finished is not None
+    stop_container.assert_called_once_with(client, container, logger)
+
+
+@pytest.mark.parametrize(
+    'fail',
+    [False, True],
+    ids=['success', 'failure'])
+def test_run_serial_journal(
+        client,
+        config,
+        container,
+        fail,
+        image,
+        logger,
+        run_env,
+        start_container,
+        stop_container):
+    """
+    Test running serially with a journal.
+
+    The records should journal their steps. A successful run removes the
+    journal, a failed run commits the container.
+
+    """
+    journal = mock.Mock(moby.Journal)
+    if fail:
+        run_env.side_effect = SystemExit(1)
+    records = []
+    with mock.patch('moby.commit_container') as commit_container, \
+            mock.patch('moby.remove_resume_images') as remove_resume_images:
+        if fail:
+            with pytest.raises(SystemExit):
+                moby.run_serial(
+                    client, image, config, logger, records=records,
+                    journal=journal)
+        else:
+            moby.run_serial(
+                client, image, config, logger, records=records,
+                journal=journal)
+    assert all(record.journal is journal for record in records)
+    if fail:
+        commit_container.assert_called_once_with(
+            client, container, journal, logger)
+        assert not journal.remove.called
+        assert not remove_resume_images.called
+    else:
+        journal.remove.assert_called_once_with()
+        remove_resume_images.assert_called_once_with(client, logger)
+        assert not commit_container.called
+    stop_container.assert_called_once_with(client, container, logger)
+
+
+def test_run_serial_commit_failure(
+        client,
+        config,
+        container,
+        image,
+        logger,
+        run_env,
+        start_container,
+        stop_container):
+    """
+    Test failing to commit the container of a failed run.
+
+    The failure to commit should be logged, the container should be stopped
+    and the failure of the environment should be raised.
+
+    """
+    journal = mock.Mock(moby.Journal)
+    run_env.side_effect = SystemExit(3)
+    error = docker.errors.APIError('commit failed')
+    with mock.patch('moby.commit_container', side_effect=error):
+        with pytest.raises(SystemExit) as raised:
+            moby.run_serial(client, image, config, logger, journal=journal)
+    assert raised.value.code == 3
+    logger.warning.assert_called_once_with(
+        'Failed to commit the container: commit failed\n')
+    stop_container.assert_called_once_with(client, container, logger)
+    assert not journal.remove.called
+
+
+def test_run_serial_resume_error(
+        client,
+        config,
+        container,
+        image,
+        logger,
+        run_env,
+        start_container,
+        stop_container):
+    """
+    Test running serially when the run can't be resumed.
+
+    The container should be stopped without committing it, so the journal
+    and the image of the failed run are kept.
+
+    """
+    journal = mock.Mock(moby.Journal)
+    run_env.side_effect = moby.ResumeError('changed')
+    with mock.patch('moby.commit_container') as commit_container:
+        with pytest.raises(moby.ResumeError):
+            moby.run_serial(client, image, config, logger, journal=journal)
+    assert not commit_container.called
+    assert not journal.remove.called
+    stop_container.assert_called_once_with(client, container, logger)
+
+
+def test_run_serial_resources(
+        client,
+        config,
+        container,
+        image,
+        logger,
+        resource_sampler,
+        run_env,
+        start_container,
+        stop_container):
+    """
+    Test sampling the resource usage when running serially.
+
+    The container should be sampled until it is stopped.
+
+    """
+    config['resources'] = True
+    records = []
+    with mock.patch('moby.measure_resources') as measure_resources:
+        moby.run_serial(client, image, config, logger, records=records)
+    resource_sampler.assert_called_once_with(client, container)
+    sampler = resource_sampler.return_value
+    sampler.start.assert_called_once_with()
+    sampler.stop.assert_called_once_with()
+    measure_resources.assert_has_calls([
+        mock.call(record, sampler.samples) for record in records
+    ])
+
+
+def test_save_history(
+        history):
+    """
+    Test saving records to the history.
+
+    The saved durations should be used to estimate the durations. Resumed
+    environments should not be saved.
+
+    """
+    for duration in [1.0, 3.0]:
+        record = moby.EnvRecord('spam')
+        record.started, record.finished = 0, duration
+        record.pushed = 10
+        moby.save_history(history, [record])
+    record = moby.EnvRecord('eggs')
+    record.exit_code = 1
+    record.finish()
+    moby.save_history(history, [record])
+    moby.save_history(history, [])
+    resumed = moby.EnvRecord('spam')
+    resumed.started, resumed.finished = 0, 0.1
+    resumed.resumed = True
+    moby.save_history(history, [resumed])
+    assert history.execute('SELECT COUNT(*) FROM runs').fetchone() == (3,)
+    durations = moby.estimate_durations(history, ['spam', 'eggs'])
+    assert durations == {'spam': 2.0}
 
 
 def test_start_container(
@@ -568,24 +2333,294 @@ def test_main(
         build_image,
         client,
         config,
-        container,
+        exclude_own_files,
         image,
         init_client,
         init_logger,
         load_config,
         logger,
-        run_env,
-        start_container,
-        stop_container):
-    """Test the main entrypoint."""
+        parse_args,
+        pipeline,
+        run_pipeline,
+        run_serial):
+    """
+    Test the main entrypoint.
+
+    When the config enables the pipeline, the environments should be run using
+    `run_pipeline`, otherwise using `run_serial`.
+
+    """
+    config['history'] = None
     moby.main()
-    init_logger.assert_called_once_with()
+    parse_args.assert_called_once_with()
     load_config.assert_called_once_with()
+    init_logger.assert_called_once_with(log_dir=None)
     init_client.assert_called_once_with()
-    build_image.assert_called_once_with(client, logger)
-    start_container.assert_called_once_with(client, image, logger)
-    run_env.calls == [
-        mock.call(client, container, config[env], logger)
-        for env in config['envlist']
-    ]
-    stop_container.assert_called_once_with(client, container, logger)
+    build_image.assert_called_once_with(client, logger, cache=None)
+    if pipeline:
+        run_pipeline.assert_called_once_with(
+            client, image, config, logger, records=[])
+        assert not run_serial.called
+    else:
+        run_serial.assert_called_once_with(
+            client, image, config, logger, records=[], journal=None)
+        assert not run_pipeline.called
+
+
+def test_main_history(
+        build_image,
+        client,
+        config,
+        exclude_own_files,
+        image,
+        init_client,
+        init_logger,
+        load_config,
+        logger,
+        parse_args,
+        pipeline,
+        run_pipeline,
+        run_serial):
+    """
+    Test the main entrypoint with a history.
+
+    The runtime should be estimated and the records should be saved. The
+    environments should be run in order.
+
+    """
+    durations = {'first': 1.0, 'second': 2.0}
+    with mock.patch('moby.open_history') as open_history, \
+            mock.patch('moby.estimate_durations', return_value=durations), \
+            mock.patch('moby.save_history') as save_history:
+        moby.main()
+    open_history.assert_called_once_with(moby.HISTORY_FILE)
+    history = open_history.return_value
+    logger.info.assert_any_call('Estimated runtime: 3.0s\n')
+    if pipeline:
+        run_pipeline.assert_called_once_with(
+            client, image, config, logger, records=[])
+    else:
+        run_serial.assert_called_once_with(
+            client, image, config, logger, records=[], journal=None)
+    save_history.assert_called_once_with(history, [])
+
+
+def test_main_history_hosts(
+        config,
+        exclude_own_files,
+        init_logger,
+        load_config,
+        logger,
+        parse_args):
+    """
+    Test the main entrypoint with a history and multiple hosts.
+
+    The environments should be run longest first and the runtime should be
+    estimated from the capacity of the hosts.
+
+    """
+    config['envlist'] = ['first', 'second', 'third']
+    config['hosts'] = ['unix:///first.sock', 'unix:///second.sock']
+    durations = {'first': 1.0, 'second': 2.0, 'third': 3.0}
+    hosts = [moby.Host(mock.Mock(), 1), moby.Host(mock.Mock(), 1)]
+    with mock.patch('moby.open_history'), \
+            mock.patch('moby.estimate_durations', return_value=durations), \
+            mock.patch('moby.save_history'), \
+            mock.patch('moby.init_hosts', return_value=hosts), \
+            mock.patch('moby.build_images'), \
+            mock.patch('moby.run_distributed') as run_distributed:
+        moby.main()
+    logger.info.assert_any_call('Estimated runtime: 3.0s\n')
+    run_distributed.assert_called_once_with(
+        hosts, mock.ANY, logger, records=[])
+    ordered = run_distributed.call_args[0][1]
+    assert ordered['envlist'] == ['third', 'second', 'first']
+
+
+def test_main_resources(
+        build_image,
+        config,
+        exclude_own_files,
+        init_client,
+        init_logger,
+        load_config,
+        logger,
+        parse_args,
+        run_serial):
+    """Test reporting the resource usage after running the environments."""
+    config['history'] = None
+    config['resources'] = True
+    with mock.patch('moby.report_resources') as report_resources:
+        moby.main()
+    report_resources.assert_called_once_with([], {}, logger)
+
+
+def test_main_hosts(
+        build_image,
+        config,
+        exclude_own_files,
+        init_client,
+        init_logger,
+        load_config,
+        logger,
+        parse_args,
+        run_pipeline,
+        run_serial):
+    """
+    Test the main entrypoint with multiple hosts.
+
+    The image should be built on every host and the environments should be
+    distributed over the hosts.
+
+    """
+    config['history'] = None
+    config['hosts'] = ['unix:///first.sock', 'unix:///second.sock']
+    with mock.patch('moby.init_hosts') as init_hosts, \
+            mock.patch('moby.build_images') as build_images, \
+            mock.patch('moby.run_distributed') as run_distributed:
+        moby.main()
+    init_hosts.assert_called_once_with(config['hosts'])
+    hosts = init_hosts.return_value
+    build_images.assert_called_once_with(hosts, logger, cache=None)
+    run_distributed.assert_called_once_with(
+        hosts, config, logger, records=[])
+    assert not init_client.called
+    assert not build_image.called
+    assert not run_pipeline.called
+    assert not run_serial.called
+
+
+def test_main_resume(
+        build_image,
+        client,
+        config,
+        exclude_own_files,
+        init_client,
+        init_logger,
+        load_config,
+        logger,
+        parse_args,
+        run_serial):
+    """
+    Test resuming a failed run.
+
+    The image should not be built, the run should resume from the committed
+    image using the journal.
+
+    """
+    config['history'] = None
+    config['resumable'] = True
+    parse_args.return_value.resume = True
+    journal = moby.Journal('journal', image='committed', completed=['step'])
+    with mock.patch('moby.load_journal', return_value=journal) as load:
+        moby.main()
+    load.assert_called_once_with(moby.JOURNAL_FILE, moby.build_fingerprint())
+    assert not build_image.called
+    run_serial.assert_called_once_with(
+        client, 'committed', config, logger, records=[], journal=journal)
+
+
+def test_main_resume_nothing(
+        build_image,
+        client,
+        config,
+        exclude_own_files,
+        image,
+        init_client,
+        init_logger,
+        load_config,
+        logger,
+        parse_args,
+        run_serial):
+    """Test resuming when there is no failed run to resume."""
+    config['history'] = None
+    config['resumable'] = True
+    parse_args.return_value.resume = True
+    with mock.patch('moby.load_journal', return_value=None), \
+            mock.patch('moby.remove_resume_images'):
+        moby.main()
+    build_image.assert_called_once_with(client, logger, cache=None)
+    run_serial.assert_called_once_with(
+        client, image, config, logger, records=[], journal=mock.ANY)
+    assert not run_serial.call_args[1]['journal'].resuming
+
+
+def test_main_resumable(
+        build_image,
+        client,
+        config,
+        exclude_own_files,
+        image,
+        init_client,
+        init_logger,
+        load_config,
+        logger,
+        parse_args,
+        run_serial):
+    """
+    Test the main entrypoint with a resumable run.
+
+    The images of previous runs should be removed and the run should be
+    journaled.
+
+    """
+    config['history'] = None
+    config['resumable'] = True
+    with mock.patch('moby.remove_resume_images') as remove_resume_images:
+        moby.main()
+    remove_resume_images.assert_called_once_with(client, logger)
+    run_serial.assert_called_once_with(
+        client, image, config, logger, records=[], journal=mock.ANY)
+    journal = run_serial.call_args[1]['journal']
+    assert journal.path == moby.JOURNAL_FILE
+    assert journal.build == moby.build_fingerprint()
+    assert not journal.resuming
+
+
+def test_main_resume_not_resumable(
+        config,
+        exclude_own_files,
+        init_logger,
+        load_config,
+        parse_args,
+        run_serial):
+    """Test resuming is refused when the run isn't resumable."""
+    config['history'] = None
+    parse_args.return_value.resume = True
+    with pytest.raises(SystemExit):
+        moby.main()
+    assert not run_serial.called
+
+
+def test_main_resume_pipeline(
+        config,
+        exclude_own_files,
+        init_logger,
+        load_config,
+        parse_args,
+        run_pipeline):
+    """Test resuming is refused with the pipeline."""
+    config['history'] = None
+    config['pipeline'] = True
+    parse_args.return_value.resume = True
+    with pytest.raises(SystemExit):
+        moby.main()
+    assert not run_pipeline.called
+
+
+def test_main_report(
+        build_image,
+        config,
+        exclude_own_files,
+        init_logger,
+        load_config,
+        logger,
+        parse_args):
+    """Test reporting the history."""
+    parse_args.return_value.history = True
+    with mock.patch('moby.open_history') as open_history, \
+            mock.patch('moby.report_history') as report_history:
+        moby.main()
+    report_history.assert_called_once_with(
+        open_history.return_value, logger)
+    assert not build_image.called